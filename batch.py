@@ -0,0 +1,152 @@
+"""
+multi-process batch driver for Converter
+"""
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from instrument import summarize_trace, format_summary
+from ocr_cache import OCRCache, merge_stats
+
+_converter = None # one Converter per worker process
+_init_error = None # traceback of a failed Converter construction in this worker
+
+def init_worker(config):
+    '''
+    a pool respawns workers whose initializer raises forever, so the error is kept and raised by convert_one
+    '''
+    global _converter, _init_error
+    try:
+        from convert import Converter
+        _converter = Converter(config)
+    except Exception:
+        _init_error = traceback.format_exc()
+
+def worker_stats():
+    '''
+    running totals of this worker: ocr cache stats and crops skipped as blank
+    '''
+    return {
+        'ocr_cache': _converter.ocr_cache.stats() if _converter.ocr_cache is not None else None,
+        'ocr_skipped': _converter.ocr_skipped
+    }
+
+def convert_one(path):
+    if _init_error is not None: # not a per-document failure, stops the batch
+        raise RuntimeError('Converter initialization failed in process %d:\n%s' % (os.getpid(), _init_error))
+    start = time.time()
+    try:
+        digest = _converter.document_digest(path) # hashed once for the check and the run
+        if _converter.up_to_date(path, digest): # outputs already written by the current stages
+            return {'path': path, 'status': 'skipped', 'elapsed': time.time() - start, 'pid': os.getpid()}
+        _converter.run(path, digest)
+    except Exception as e:
+        return {
+            'path': path,
+            'status': 'failed',
+            'error': repr(e),
+            'traceback': traceback.format_exc(),
+            'elapsed': time.time() - start,
+            'pid': os.getpid(),
+            'stats': worker_stats()
+        }
+    return {
+        'path': path,
+        'status': 'ok',
+        'elapsed': time.time() - start,
+        'pid': os.getpid(),
+        'stats': worker_stats()
+    }
+
+def report_progress(done, total, failed, start):
+    elapsed = time.time() - start
+    speed = done/elapsed if elapsed > 0 else 0.
+    sys.stdout.write('\r[%d/%d] %.2f docs/s, %d failed, %.0fs elapsed' % (done, total, speed, failed, elapsed))
+    sys.stdout.flush()
+
+def run_batch(config, paths, workers=1, log_path=None, chunksize=1):
+    '''
+    convert every path in paths, spreading them over `workers` processes
+    failures are written as json lines (path, error, traceback) to log_path
+    with config["trace_path"] set, per-stage timings are written there and summarized at the end
+    with config["checkpoint_dir"] set, documents whose outputs are up to date are skipped
+    return a summary dict with counts and throughput
+    '''
+    if log_path is None:
+        log_path = os.path.join(config["output_dir"], "failures.jsonl")
+    if os.path.dirname(log_path):
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    trace_path = config.get("trace_path")
+    if trace_path:
+        if os.path.dirname(trace_path):
+            os.makedirs(os.path.dirname(trace_path), exist_ok=True)
+        open(trace_path, 'w').close() # workers append one line per document
+    total = len(paths)
+    done = 0
+    failed = 0
+    skipped = 0
+    workers_stats = dict() # pid -> latest worker_stats() of that worker
+    start = time.time()
+    with open(log_path, 'w') as log:
+        if workers <= 1:
+            init_worker(config)
+            if _init_error is not None:
+                raise RuntimeError('Converter initialization failed:\n%s' % _init_error)
+            if config.get("pipeline_depth", 0) > 0:
+                results = _converter.run_pipelined(paths)
+            else:
+                results = map(convert_one, paths)
+            pool = None
+        else:
+            # spawn so that each worker loads its own models instead of inheriting a forked cuda context
+            ctx = multiprocessing.get_context('spawn')
+            pool = ctx.Pool(workers, initializer=init_worker, initargs=(config,))
+            results = pool.imap_unordered(convert_one, paths, chunksize)
+        try:
+            for res in results:
+                done += 1
+                if 'stats' in res:
+                    workers_stats[res['pid']] = res.pop('stats')
+                if res['status'] == 'skipped':
+                    skipped += 1
+                elif res['status'] != 'ok':
+                    failed += 1
+                    log.write(json.dumps(res) + '\n')
+                    log.flush()
+                report_progress(done, total, failed, start)
+        except BaseException:
+            if pool is not None:
+                pool.terminate() # do not wait for the remaining documents
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join() # workers drain their own visualization queues on exit
+            else:
+                _converter.close()
+    sys.stdout.write('\n')
+    elapsed = time.time() - start
+    if trace_path:
+        print(format_summary(summarize_trace(trace_path)))
+    stats = [worker_stats()] if pool is None else list(workers_stats.values())
+    ocr_cache = None
+    if config.get("ocr_cache_dir"):
+        ocr_cache = merge_stats([s['ocr_cache'] for s in stats])
+        ocr_cache['evicted'] = OCRCache.for_weights(
+            config["ocr_cache_dir"], config.get("ocr_weight"), max_bytes=config.get("ocr_cache_bytes", 1 << 30)
+        ).evict()
+    return {
+        'total': total,
+        'succeeded': done - failed - skipped,
+        'failed': failed,
+        'skipped': skipped,
+        'elapsed': elapsed,
+        'docs_per_sec': done/elapsed if elapsed > 0 else 0.,
+        'failure_log': log_path,
+        'trace': trace_path,
+        'ocr_cache': ocr_cache,
+        'ocr_skipped': sum(s['ocr_skipped'] for s in stats)
+    }
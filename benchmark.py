@@ -0,0 +1,274 @@
+"""
+benchmarks of the post-processing and metric hot paths
+run: python benchmark.py [--sizes 10 50 100 200] [--save baseline.json] [--baseline baseline.json]
+     python benchmark.py --check_json <gt json dir> <pd json dir>  (table matching against rndtable's IoU)
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import string
+import tempfile
+import time
+
+import numpy as np
+from openpyxl import Workbook, load_workbook
+
+from utility import locate_layouts
+from utils import sort_layout_output
+import metrics
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def corners(x0, y0, x1, y1):
+    return [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+
+def header_groups(cols, merged_headers):
+    '''
+    column groups of the header row: `merged_headers` groups of 2 columns from the left, then single columns
+    '''
+    groups = []
+    col = 0
+    while col < cols:
+        width = 2 if len(groups) < merged_headers and col + 1 < cols else 1
+        groups.append((col, col + width - 1))
+        col += width
+    return groups
+
+def generate_table(rows=20, cols=6, merged_headers=1, noise=0.1, seed=0, cell_w=120, cell_h=30):
+    '''
+    synthetic table in table coordinates: cells (with 'location') and text layouts (with 'location')
+    noise: fraction of empty cells and of layouts split in 2 words, also scales the position jitter
+    '''
+    rng = random.Random(seed)
+    cells = []
+    layouts = []
+    jitter = int(noise * cell_h * 0.2)
+
+    def add_layout(x0, y0, x1, y1):
+        dx = rng.randint(-jitter, jitter)
+        dy = rng.randint(-jitter, jitter)
+        w = max(8, int((x1 - x0 - 8) * rng.uniform(0.4, 0.9)))
+        lx0, ly0 = x0 + 4 + dx, y0 + 6 + dy
+        lx1, ly1 = lx0 + w, y1 - 6 + dy
+        if rng.random() < noise and w > 30: # 2 words, merged back by merge_layouts
+            mid = lx0 + w // 2
+            layouts.append({'location': corners(lx0, ly0, mid - 2, ly1)})
+            layouts.append({'location': corners(mid + 2, ly0, lx1, ly1)})
+        else:
+            layouts.append({'location': corners(lx0, ly0, lx1, ly1)})
+
+    for start_col, end_col in header_groups(cols, merged_headers):
+        x0, x1 = start_col * cell_w, (end_col + 1) * cell_w
+        cells.append({'type': 'cell', 'location': corners(x0, 0, x1, cell_h)})
+        add_layout(x0, 0, x1, cell_h)
+    for row in range(1, rows):
+        for col in range(cols):
+            x0, y0 = col * cell_w, row * cell_h
+            cells.append({'type': 'cell', 'location': corners(x0, y0, x0 + cell_w, y0 + cell_h)})
+            if rng.random() >= noise * 0.5:
+                add_layout(x0, y0, x0 + cell_w, y0 + cell_h)
+    return cells, layouts
+
+def perturb(text, rng, noise):
+    chars = list(text)
+    for idx in range(len(chars)):
+        if rng.random() < noise:
+            chars[idx] = rng.choice(string.ascii_lowercase)
+    return ''.join(chars)
+
+def generate_sheet(rows=20, cols=6, merged_headers=1, noise=0.0, seed=0, title='table_1'):
+    '''
+    synthetic worksheet with merged header cells, noise perturbs texts and empties cells
+    '''
+    rng = random.Random(seed)
+    wb = Workbook()
+    sheet = wb.active
+    sheet.title = title
+    for start_col, end_col in header_groups(cols, merged_headers):
+        sheet.cell(row=1, column=start_col + 1).value = perturb('header %d' % start_col, rng, noise)
+        if end_col > start_col:
+            sheet.merge_cells(start_row=1, start_column=start_col + 1, end_row=1, end_column=end_col + 1)
+    for row in range(2, rows + 1):
+        for col in range(1, cols + 1):
+            if rng.random() < noise * 0.5:
+                continue
+            sheet.cell(row=row, column=col).value = perturb('item %d-%d' % (row % 37, col), rng, noise)
+    return sheet
+
+class StubOCR:
+    def process(self, image):
+        return {'text': 'x' * max(1, image.shape[1] // 10)}
+
+    def process_batch(self, images):
+        return [self.process(img) for img in images]
+
+def measure(func, setup=None, repeat=5):
+    '''
+    run func(setup()) `repeat` times, setup is not timed, return min and median seconds
+    '''
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': float(np.median(times))}
+
+def scaling_exponent(sizes, times):
+    '''
+    slope of log(time) against log(size): ~1 linear, ~2 quadratic
+    '''
+    if len(sizes) < 2:
+        return None
+    return float(np.polyfit(np.log(sizes), np.log(np.maximum(times, 1e-9)), 1)[0])
+
+def bench_locate_layouts(rows, cols, args):
+    cells, layouts = generate_table(rows, cols, args.merged_headers, args.noise, args.seed)
+    return measure(locate_layouts, lambda: (cells, copy.deepcopy(layouts)), args.repeat)
+
+def bench_sort_layout_output(rows, cols, args):
+    _, layouts = generate_table(rows, cols, args.merged_headers, args.noise, args.seed)
+    shuffled = layouts[:]
+    random.Random(args.seed).shuffle(shuffled)
+    return measure(sort_layout_output, lambda: (copy.deepcopy(shuffled),), args.repeat)
+
+def bench_convert_sheet2tree(rows, cols, args):
+    sheet = generate_sheet(rows, cols, args.merged_headers, 0., args.seed)
+    return measure(metrics.convert_sheet2tree, lambda: (sheet,), args.repeat)
+
+def bench_cal_TEDS(rows, cols, args):
+    label_table = metrics.LabelTable() # shared like in compare_tables
+    gt = metrics.convert_sheet2tree(generate_sheet(rows, cols, args.merged_headers, 0., args.seed), label_table=label_table)
+    pd = metrics.convert_sheet2tree(generate_sheet(rows, cols, args.merged_headers, args.noise, args.seed + 1), label_table=label_table)
+    def setup():
+        label_table.distances.clear() # time the cold path of every repeat
+        return gt, pd
+    return measure(metrics.cal_TEDS, setup, args.repeat)
+
+def make_converter(output_dir):
+    from convert import Converter # needs the model packages importable, weights are not loaded
+    config = {"output_dir": output_dir}
+    return Converter(config, table_model=object(), layout_model=object(), ocr_model=StubOCR())
+
+def bench_extract_xlsx(rows, cols, args):
+    cells, layouts = generate_table(rows, cols, args.merged_headers, args.noise, args.seed)
+    layout_output = locate_layouts(cells, copy.deepcopy(layouts))
+    image = np.full((rows * 30 + 40, cols * 120 + 40, 3), 255, dtype=np.uint8)
+    converter = make_converter(args.output_dir)
+    return measure(
+        lambda wb: converter.extract_xlsx(image, layout_output, wb, 0),
+        lambda: (converter.new_workbook(),), args.repeat
+    )
+
+BENCHMARKS = {
+    'locate_layouts': bench_locate_layouts,
+    'sort_layout_output': bench_sort_layout_output,
+    'convert_sheet2tree': bench_convert_sheet2tree,
+    'cal_TEDS': bench_cal_TEDS,
+    'extract_xlsx': bench_extract_xlsx,
+}
+
+def bench_fixtures(args):
+    '''
+    bundled gt.xlsx / pd.xlsx: tree construction of every sheet and the whole compare_excels
+    '''
+    gt_path = os.path.join(ROOT, 'gt.xlsx')
+    pd_path = os.path.join(ROOT, 'pd.xlsx')
+    gt_sheets = load_workbook(gt_path).worksheets
+    return {
+        'fixture_convert_sheet2tree': measure(lambda: [metrics.convert_sheet2tree(s) for s in gt_sheets], repeat=args.repeat),
+        'fixture_compare_excels': measure(lambda: metrics.compare_excels(gt_path, pd_path), repeat=args.repeat),
+    }
+
+def run(args):
+    report = {
+        'machine': platform.platform(),
+        'python': platform.python_version(),
+        'params': {'cols': args.cols, 'sizes': args.sizes, 'merged_headers': args.merged_headers,
+                   'noise': args.noise, 'seed': args.seed, 'repeat': args.repeat},
+        'results': dict(),
+        'scaling': dict()
+    }
+    for name, bench in BENCHMARKS.items():
+        if args.only and name not in args.only:
+            continue
+        medians = []
+        for rows in args.sizes:
+            try:
+                res = bench(rows, args.cols, args)
+            except ImportError as e:
+                print('%-24s skipped (%s)' % (name, e))
+                break
+            key = '%s/%dx%d' % (name, rows, args.cols)
+            report['results'][key] = res
+            medians.append(res['median'])
+            print('%-36s min %9.4fs  median %9.4fs' % (key, res['min'], res['median']))
+        if len(medians) == len(args.sizes):
+            exponent = scaling_exponent([rows * args.cols for rows in args.sizes], medians)
+            report['scaling'][name] = exponent
+            if exponent is not None:
+                print('%-36s scaling exponent %.2f' % (name, exponent))
+    for key, res in bench_fixtures(args).items():
+        report['results'][key] = res
+        print('%-36s min %9.4fs  median %9.4fs' % (key, res['min'], res['median']))
+    return report
+
+def compare_baseline(report, baseline, tolerance):
+    '''
+    print the ratio of every median to the baseline, return the keys slower than tolerance
+    '''
+    regressions = []
+    print('\n%-36s %10s %10s %7s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for key, res in sorted(report['results'].items()):
+        if key not in baseline['results']:
+            continue
+        base = baseline['results'][key]['median']
+        ratio = res['median'] / base if base > 0 else float('inf')
+        flag = '  <-- slower' if ratio > tolerance else ''
+        print('%-36s %9.4fs %9.4fs %6.2fx%s' % (key, base, res['median'], ratio, flag))
+        if ratio > tolerance:
+            regressions.append(key)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 100, 200], help='number of table rows')
+    parser.add_argument('--cols', type=int, default=8, help='number of table columns')
+    parser.add_argument('--merged_headers', type=int, default=2, help='header cells spanning 2 columns')
+    parser.add_argument('--noise', type=float, default=0.1, help='empty cells / split words / text noise')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='*', help='run only these benchmarks')
+    parser.add_argument('--output_dir', default=None, help='output dir of the stub Converter, a removed temp dir by default')
+    parser.add_argument('--save', help='write the report to this json file (new baseline)')
+    parser.add_argument('--baseline', help='json report to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='ratio above which a benchmark is a regression')
+    parser.add_argument('--check_json', nargs=2, metavar=('GT_DIR', 'PD_DIR'),
+                        help='only check metrics.match_tables against metrics.scan_tables on these json pairs')
+    args = parser.parse_args()
+
+    if args.check_json:
+        mismatches = metrics.check_match_tables(*args.check_json)
+        for name, idx, ref, new in mismatches:
+            print('%s table %d: reference %s, match_tables %s' % (name, idx + 1, ref, new))
+        print('%d mismatch(es)' % len(mismatches))
+        raise SystemExit(1 if mismatches else 0)
+
+    if args.output_dir:
+        report = run(args)
+    else:
+        with tempfile.TemporaryDirectory() as output_dir:
+            args.output_dir = output_dir
+            report = run(args)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_baseline(report, json.load(f), args.tolerance)
+        if regressions:
+            print('\n%d regression(s): %s' % (len(regressions), ', '.join(regressions)))
+            raise SystemExit(1)
@@ -0,0 +1,90 @@
+"""
+stage checkpoints of Converter: detector outputs and recognized tables of every page, keyed by content
+"""
+import gzip
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from eval_cache import atomic_write
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = ('detect', 'recognize', 'write')
+
+# modules whose code produces the output of a stage, any change to them invalidates the stage
+STAGE_MODULES = {
+    'detect': ('pages', 'tiling', 'spatial'),
+    'recognize': ('convert', 'utility', 'utils', 'spatial', 'ocr_batch'),
+    'write': ('convert',),
+}
+
+def source_digest(modules):
+    h = hashlib.sha1()
+    for name in modules:
+        with open(os.path.join(ROOT, name + '.py'), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def chain_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def to_json(obj):
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError('%r is not json serializable' % type(obj))
+
+class CheckpointStore:
+    def __init__(self, root):
+        '''
+        root/<stage>/<key[:2]>/<key>.json.gz: gzipped json output of a stage
+        root/outputs/<name>.json: write key and files of the last completed write of page `name`
+        '''
+        self.root = os.path.abspath(root)
+        self.hits = dict((stage, 0) for stage in STAGES)
+        for stage in STAGES[:-1] + ('outputs',):
+            os.makedirs(os.path.join(self.root, stage), exist_ok=True)
+
+    def path(self, stage, key):
+        return os.path.join(self.root, stage, key[:2], key + '.json.gz')
+
+    def get(self, stage, key):
+        try:
+            with gzip.open(self.path(stage, key), 'rt', encoding='utf-8') as f:
+                value = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        self.hits[stage] += 1
+        return value
+
+    def put(self, stage, key, value):
+        def write(tmp):
+            with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+                json.dump(value, f, default=to_json, separators=(',', ':'))
+        atomic_write(self.path(stage, key), write)
+
+    def record_path(self, name):
+        return os.path.join(self.root, 'outputs', name + '.json')
+
+    def is_done(self, name, key):
+        '''
+        True when the last write of page `name` used this key and its files still exist
+        '''
+        try:
+            with open(self.record_path(name)) as f:
+                record = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        return record['key'] == key and all(os.path.exists(path) for path in record['outputs'])
+
+    def mark_done(self, name, key, outputs):
+        def write(tmp):
+            with open(tmp, 'w') as f:
+                json.dump({'key': key, 'outputs': outputs}, f)
+        atomic_write(self.record_path(name), write)
@@ -6,9 +6,21 @@ import os
 # import xlrd
 # import xlwt
 # from xlwt import Workbook 
-from openpyxl import load_workbook, Workbook
+from openpyxl import Workbook
+from openpyxl.worksheet.cell_range import CellRange
 
 from utility import visualize_layout, visualize_table, check_layout_in_cell, locate_layouts, location2bbox
+from spatial import SpatialIndex, corners2bbox
+from ocr_batch import batch_ocr, ink_integral, ink_density
+from ocr_cache import OCRCache
+from batch import run_batch
+from pipeline import run_pipelined
+from instrument import make_tracer
+from visual_writer import VisualWriter
+from pages import Page, count_pages, page_name, scale_boxes
+from tiling import tiled_detection
+from checkpoint import CheckpointStore, STAGES, STAGE_MODULES, chain_key, source_digest
+from eval_cache import file_digest
 
 from table import Tee
 from table.classes import Table
@@ -16,10 +28,68 @@ from layout import InvoiceLayout, JeffLayout
 from ocr import CannetOCR
 
 class Converter:
-    def __init__(self, config):
-        self.table_model = Tee(weights_path=config["table_weight"])
-        self.layout_model = JeffLayout(config["layout_weight"])
-        self.ocr_model = CannetOCR(config["ocr_weight"])
+    def __init__(self, config, table_model=None, layout_model=None, ocr_model=None):
+        # models can be injected (benchmarks, tests), otherwise they are loaded from the configured weights
+        self.table_model = table_model or Tee(weights_path=config["table_weight"])
+        self.layout_model = layout_model or JeffLayout(config["layout_weight"])
+        self.ocr_model = ocr_model or CannetOCR(config["ocr_weight"])
+        self.ocr_batch_size = config.get("ocr_batch_size", 32) # only used by ocr models with process_batch
+        self.ocr_bucket_size = config.get("ocr_bucket_size", 16)
+        self.ink_threshold = config.get("ink_threshold", 0.0) # crops with less ink get '' without OCR
+        self.ink_level = config.get("ink_level", 128) # gray level below which a pixel is ink
+        self.ocr_skipped = 0
+        # post-processing thresholds: check_layout_in_cell, is_available_merged and cells_same_col
+        self.in_cell_threshold = config.get("in_cell_threshold", 0.5)
+        self.merge_gap_threshold = config.get("merge_gap_threshold", 0.2)
+        self.header_col_threshold = config.get("header_col_threshold", 0.8)
+        self.ocr_cache = None
+        if config.get("ocr_cache_dir"):
+            self.ocr_cache = OCRCache.for_weights(
+                config["ocr_cache_dir"], config.get("ocr_weight"),
+                max_bytes=config.get("ocr_cache_bytes", 1 << 30), memory_items=config.get("ocr_cache_memory", 100000)
+            )
+        self.pipeline_depth = config.get("pipeline_depth", 0)
+        self.xlsx_write_only = config.get("xlsx_write_only", False)
+        self.detect_scale = config.get("detect_scale", 1.0) # < 1: detectors run on a reduced copy of the page
+        self.all_pages = config.get("all_pages", False) # every page of multi-page tiffs, one at a time
+        self.detect_tile = config.get("detect_tile", 0) # > 0: detectors run on overlapping tiles of this size
+        self.detect_tile_overlap = config.get("detect_tile_overlap", 256)
+        self.detect_nms_threshold = config.get("detect_nms_threshold", 0.5)
+        self.tracer = make_tracer(config.get("trace_path")) # no-op unless a trace file is configured
+        self.checkpoints = None
+        if config.get("checkpoint_dir"):
+            # a stage is rerun when its inputs, its settings, its weights or its code change
+            self.checkpoints = CheckpointStore(config["checkpoint_dir"])
+            self.stage_identity = {
+                'detect': chain_key(
+                    file_digest(config.get("table_weight")), file_digest(config.get("layout_weight")),
+                    self.detect_scale, self.detect_tile, self.detect_tile_overlap, self.detect_nms_threshold
+                ),
+                'recognize': chain_key(
+                    file_digest(config.get("ocr_weight")), self.ink_threshold, self.ink_level,
+                    self.ocr_batch_size, self.ocr_bucket_size,
+                    self.in_cell_threshold, self.merge_gap_threshold, self.header_col_threshold
+                ),
+                'write': chain_key(self.xlsx_write_only, os.path.abspath(config["output_dir"])), # outputs of another dir don't count
+            }
+            for stage in STAGES:
+                self.stage_identity[stage] = chain_key(self.stage_identity[stage], source_digest(STAGE_MODULES[stage]))
+        # visualize: "sync" (default), "off", "sampled" (every visualize_every-th document and/or failures) or "async"
+        self.visualize_mode = config.get("visualize", "sync")
+        self.visualize_every = config.get("visualize_every", 0)
+        self.visualize_failures = config.get("visualize_failures", True)
+        self.visualize_ext = '.' + config.get("visualize_format", "png").lstrip('.').lower()
+        self.visualize_params = []
+        compression = config.get("visualize_compression", None) # png: zlib level 0-9, jpg/webp: quality 0-100
+        if compression is not None:
+            flag = cv2.IMWRITE_PNG_COMPRESSION if self.visualize_ext == '.png' else (
+                cv2.IMWRITE_WEBP_QUALITY if self.visualize_ext == '.webp' else cv2.IMWRITE_JPEG_QUALITY
+            )
+            self.visualize_params = [flag, int(compression)]
+        self.visualized = 0 # documents seen by the sampler
+        self.visual_writer = None
+        if self.visualize_mode == "async":
+            self.visual_writer = VisualWriter(self.draw, config.get("visualize_queue", 4))
         self.OUTPUT_DIR = config["output_dir"]
         if not os.path.exists(self.OUTPUT_DIR):
             os.makedirs(self.OUTPUT_DIR)
@@ -28,28 +98,127 @@ class Converter:
         if not os.path.exists(os.path.join(self.OUTPUT_DIR, "prediction")):
             os.makedirs(os.path.join(self.OUTPUT_DIR, "prediction"))
 
+    def should_visualize(self, failed=False):
+        if self.visualize_mode == "off":
+            return False
+        if failed: # failed documents are only drawn on request in sampled mode
+            return self.visualize_mode == "sampled" and self.visualize_failures
+        if self.visualize_mode != "sampled":
+            return True
+        self.visualized += 1
+        return self.visualize_every > 0 and (self.visualized - 1) % self.visualize_every == 0
+
     def visualize(self, extraction, origin_image, name, prefix=''):
+        with self.tracer.stage('visualize'):
+            if self.visual_writer is not None:
+                self.visual_writer.put(extraction, origin_image, name, prefix)
+            else:
+                self.draw(extraction, origin_image, name, prefix)
+
+    def draw(self, extraction, origin_image, name, prefix=''):
+        if isinstance(origin_image, Page):
+            origin_image = origin_image.full
+        out_dir = os.path.join(self.OUTPUT_DIR, "visualization", name)
+        os.makedirs(out_dir, exist_ok=True)
         overview = visualize_layout(extraction['layout_output'], origin_image)
         overview = visualize_table(extraction['refined_boxes'], overview)
-        cv2.imwrite(os.path.join(self.OUTPUT_DIR, "visualization", name, prefix + '-overview-' + name + '.png'), overview)
+        cv2.imwrite(os.path.join(out_dir, prefix + '-overview-' + name + self.visualize_ext), overview, self.visualize_params)
     
         for idx, (img, cells, layouts) in enumerate(zip(extraction['tables'], extraction['cells'], extraction['layouts'])):
             img = visualize_table(cells, img)
             img = visualize_layout(layouts, img)
-            filename = prefix + 'table_' + str(idx+1) + '-' + name + '.png'
-            path = os.path.join(self.OUTPUT_DIR, "visualization", name, filename)
-            cv2.imwrite(path, img)
+            filename = prefix + 'table_' + str(idx+1) + '-' + name + self.visualize_ext
+            cv2.imwrite(os.path.join(out_dir, filename), img, self.visualize_params)
+
+    def document_digest(self, path):
+        '''
+        content digest of a document, computed once per document and passed down to its pages
+        '''
+        if self.checkpoints is None:
+            return None
+        return file_digest(path)
+
+    def stage_keys(self, digest, index=0):
+        '''
+        checkpoint key of every stage of page `index` of the document with content digest `digest`,
+        each key depends on the keys of the stages before it
+        '''
+        key = chain_key(digest, index)
+        keys = dict()
+        for stage in STAGES:
+            key = chain_key(key, self.stage_identity[stage])
+            keys[stage] = key
+        return keys
+
+    def page_keys(self, page):
+        if self.checkpoints is None or page.path is None:
+            return None
+        if page.digest is None:
+            page.digest = file_digest(page.path)
+        return self.stage_keys(page.digest, page.index)
+
+    def up_to_date(self, path, digest=None):
+        '''
+        True when the outputs of every page of path were written with the current stage keys
+        '''
+        if self.checkpoints is None:
+            return False
+        digest = digest or file_digest(path)
+        return all(
+            self.checkpoints.is_done(page_name(path, index), self.stage_keys(digest, index)['write'])
+            for index in self.page_indices(path)
+        )
+
+    def detect(self, page):
+        small, (fx, fy) = page.detect_image(self.detect_scale)
+        if self.detect_tile > 0 and max(small.shape[:2]) > self.detect_tile:
+            refined_boxes, result = tiled_detection(
+                small, self.table_model, self.layout_model, self.detect_tile,
+                self.detect_tile_overlap, self.detect_nms_threshold, self.tracer
+            )
+        else:
+            with self.tracer.stage('table_model'):
+                refined_boxes = self.table_model.process(small, resize=True, refine=True)
+            with self.tracer.stage('layout_model'):
+                result = self.layout_model.process(small)
+        return scale_boxes(refined_boxes, fx, fy), scale_boxes(result, fx, fy)
 
     def extract_coordinate(self, image, topdown=True):
         #pp2
-        refined_boxes = self.table_model.process(image, resize=True, refine=True)
-        result = self.layout_model.process(image)
-    
+        page = image if isinstance(image, Page) else Page(None, image=image)
+        keys = self.page_keys(page)
+        detected = self.checkpoints.get('detect', keys['detect']) if keys else None
+        if detected is not None:
+            refined_boxes, result = detected['refined_boxes'], detected['layout_output']
+            self.tracer.count('checkpoint_detect')
+        else:
+            refined_boxes, result = self.detect(page)
+        with self.tracer.stage('crop_tables'):
+            extraction = self.assign_layouts(page, refined_boxes, result, topdown)
+        if keys:
+            extraction['keys'] = keys
+            if detected is None:
+                self.checkpoints.put('detect', keys['detect'], {
+                    'refined_boxes': refined_boxes,
+                    'layout_output': result,
+                    'table_locations': extraction['table_locations']
+                })
+        self.tracer.count('tables', len(extraction['tables']))
+        self.tracer.count('cells', sum(len(cells) for cells in extraction['cells']))
+        self.tracer.count('layouts', len(result))
+        return extraction
+
+    def assign_layouts(self, page, refined_boxes, result, topdown=True):
+        '''
+        crop every detected table and move its cells and layouts into table coordinates
+        tables are views of the full resolution page, which is only decoded if the page has a table
+        '''
         table_images = []
         layout_results = []
         cell_results = []
         table_locations = []
 
+        layout_index = SpatialIndex([corners2bbox(lay['location']) for lay in result]) # built once per page
         sorted_tables = list(filter(lambda x: x["type"] == "table", refined_boxes))
         if topdown:
             sorted_tables.sort(key=lambda x: x['location'][0][1]) # this is a simple sort that needs to be updated 
@@ -59,7 +228,7 @@ class Converter:
                 location = entity['location']
                 table_locations.append(location)
                 tlbr_poses = location2bbox(location)
-                table = image[
+                table = page.full[
                     tlbr_poses[1]:tlbr_poses[3], tlbr_poses[0]:tlbr_poses[2]
                 ] # Image of table
                 table_images.append(table)
@@ -68,8 +237,9 @@ class Converter:
                 }
             
                 res = [] # layouts that belongs to this table
-                for idx, lay in enumerate(result):
-                    if check_layout_in_cell(lay, tab):
+                for idx in layout_index.query(corners2bbox(tab['location'])):
+                    lay = result[idx]
+                    if check_layout_in_cell(lay, tab, self.in_cell_threshold):
                         tmp = dict()
                         tmp['location'] = [(x - tlbr_poses[0], y - tlbr_poses[1]) for (x,y) in lay['location']]
                         res.append(tmp) 
@@ -91,51 +261,210 @@ class Converter:
             'layout_output': result
         }
 
-    def extract_xlsx(self, table, layout_output, filepath, idx):
-        if os.path.isfile(filepath):
-            wb = load_workbook(filepath)
-            wb.create_sheet()
-            wb.active = idx
-        else:
-            wb = Workbook()
-    
-        sheet = wb.active 
-        sheet.title = 'table_' + str(idx+1)
-        for idx, lay in enumerate(layout_output):  
+    def crop_layouts(self, table, layout_output):
+        integral = None
+        if self.ink_threshold > 0 and table.size != 0:
+            integral = ink_integral(table, self.ink_level) # once per table, O(1) density per layout
+        crops = []
+        skipped = 0
+        for lay in layout_output:
             x0, y0, x1, y1 = lay['bbox']
-            if table[y0:y1, x0:x1].size == 0:
-                field = {
-                    'text': ''
-                }
+            crop = table[y0:y1, x0:x1]
+            if integral is not None and crop.size != 0 and ink_density(integral, lay['bbox']) < self.ink_threshold:
+                crop = crop[:0] # empty crops are not sent to the model
+                skipped += 1
+            crops.append(crop)
+        self.ocr_skipped += skipped
+        self.tracer.count('ocr_skipped', skipped)
+        return crops
+
+    def recognize_tables(self, tables):
+        '''
+        tables: list of (table image, layout_output), possibly from several pages
+        run OCR over the crops of all tables together and return one list of texts per table
+        '''
+        crops = []
+        for img, layout_output in tables:
+            crops.extend(self.crop_layouts(img, layout_output))
+        self.tracer.count('ocr_crops', len(crops))
+        with self.tracer.stage('ocr'):
+            if self.ocr_cache is None:
+                texts = batch_ocr(self.ocr_model, crops, self.ocr_batch_size, self.ocr_bucket_size)
+            else: # only crops never seen before reach the model
+                misses = self.ocr_cache.misses
+                texts = self.ocr_cache.recognize(
+                    crops, lambda missing: batch_ocr(self.ocr_model, missing, self.ocr_batch_size, self.ocr_bucket_size)
+                )
+                self.tracer.count('ocr_cache_misses', self.ocr_cache.misses - misses)
+        results = []
+        offset = 0
+        for img, layout_output in tables:
+            results.append(texts[offset:offset + len(layout_output)])
+            offset += len(layout_output)
+        return results
+
+    def new_workbook(self):
+        wb = Workbook(write_only=self.xlsx_write_only)
+        if not self.xlsx_write_only:
+            wb.remove(wb.active) # sheets are created per table
+        return wb
+
+    def stream_sheet(self, sheet, layout_output, texts):
+        '''
+        write-only worksheets only accept whole rows in order, so lay the texts out on a grid first
+        '''
+        grid = dict()
+        merged = []
+        n_rows = 0
+        n_cols = 0
+        for lay, text in zip(layout_output, texts):
+            if lay['line'] == 0:
+                start_col, end_col = lay['col']
+                merged.append((start_col, end_col))
+                grid[(0, start_col)] = text
+                n_cols = max(n_cols, end_col + 1)
             else:
-                field = self.ocr_model.process(table[y0:y1, x0:x1])
-            
+                grid[(lay['line'], lay['col'])] = text
+                n_cols = max(n_cols, lay['col'] + 1)
+            n_rows = max(n_rows, lay['line'] + 1)
+        for start_col, end_col in merged:
+            for col in range(start_col + 1, end_col + 1):
+                grid.pop((0, col), None) # merged cells only keep the top-left value
+            sheet.merged_cells.add(CellRange(min_col=start_col + 1, min_row=1, max_col=end_col + 1, max_row=1))
+        for row in range(n_rows):
+            sheet.append([grid.get((row, col)) for col in range(n_cols)])
+
+    def extract_xlsx(self, table, layout_output, wb, idx, texts=None):
+        if texts is None:
+            texts = self.recognize_tables([(table, layout_output)])[0]
+        sheet = wb.create_sheet('table_' + str(idx+1))
+        if self.xlsx_write_only:
+            self.stream_sheet(sheet, layout_output, texts)
+            return
+        for lay, text in zip(layout_output, texts):
             if lay['line'] == 0:
                 sheet.merge_cells(start_row=1, start_column=lay['col'][0] + 1, end_row=1, end_column=lay['col'][1] + 1) 
-                sheet.cell(row = 1, column = lay['col'][0] + 1).value = field['text']
+                sheet.cell(row = 1, column = lay['col'][0] + 1).value = text
             else:
-                sheet.cell(row = lay['line'] + 1, column = lay['col'] + 1).value = field['text']
-        wb.save(filepath) 
+                sheet.cell(row = lay['line'] + 1, column = lay['col'] + 1).value = text
 
-    def convert(self, extraction, name , prefix=''):
+    def recognize(self, extraction):
+        '''
+        locate layouts inside every table of the page and OCR them
+        return a list of (table index, table image, layout_output, texts)
+        '''
+        keys = extraction.get('keys')
+        if keys:
+            cached = self.checkpoints.get('recognize', keys['recognize'])
+            if cached is not None:
+                self.tracer.count('checkpoint_recognize')
+                return [(idx, extraction['tables'][idx], layout_output, texts) for idx, layout_output, texts in cached]
+        recognized = self.recognize_page(extraction)
+        if keys:
+            self.checkpoints.put('recognize', keys['recognize'], [
+                [idx, layout_output, texts] for idx, _, layout_output, texts in recognized
+            ])
+        return recognized
+
+    def recognize_page(self, extraction):
+        located = []
         for idx, (img, cells, layouts) in enumerate(zip(extraction['tables'], extraction['cells'], extraction['layouts'])):
             try:
-                layout_output = locate_layouts(cells, layouts)                
+                with self.tracer.stage('locate_layouts'):
+                    layout_output = locate_layouts(
+                        cells, layouts, self.in_cell_threshold, self.merge_gap_threshold, self.header_col_threshold
+                    )
             except:
                 continue
-            filename = prefix + name + '.xlsx'
-            path = os.path.join(self.OUTPUT_DIR, "prediction", filename)
-            self.extract_xlsx(img, layout_output, path, idx)
-
-    def run(self, path):
-        name = os.path.basename(os.path.splitext(path)[0])
-        if not os.path.exists(os.path.join(self.OUTPUT_DIR, "visualization", name)):
-            os.makedirs(os.path.join(self.OUTPUT_DIR, "visualization", name))
-        
-        origin_image = cv2.imread(path)
-        extraction = self.extract_coordinate(origin_image)
-        self.visualize(extraction, origin_image, name)
-        self.convert(extraction, name)
+            located.append((idx, img, layout_output))
+
+        # one batched OCR pass over every crop of every table on the page
+        texts = self.recognize_tables([(img, layout_output) for _, img, layout_output in located])
+        return [(idx, img, layout_output, table_texts) for (idx, img, layout_output), table_texts in zip(located, texts)]
+
+    def write_xlsx(self, recognized, name, prefix=''):
+        '''
+        return the path of the written file, None when the page has no table
+        '''
+        if len(recognized) == 0:
+            return None
+        # all sheets of the document are built in memory and the file is written once
+        with self.tracer.stage('xlsx_build'):
+            wb = self.new_workbook()
+            for idx, img, layout_output, texts in recognized:
+                self.extract_xlsx(img, layout_output, wb, idx, texts)
+        path = os.path.join(self.OUTPUT_DIR, "prediction", prefix + name + '.xlsx')
+        with self.tracer.stage('xlsx_save'):
+            wb.save(path)
+        return path
+
+    def convert(self, extraction, name , prefix=''):
+        self.write_xlsx(self.recognize(extraction), name, prefix)
+
+    def decode(self, path, index=0, digest=None):
+        '''
+        return the output name and the Page of page `index` of path, decoded for the detectors
+        digest: document_digest(path), hashed here when not given
+        '''
+        with self.tracer.stage('decode'):
+            page = Page(path, index, digest=digest)
+            keys = self.page_keys(page)
+            if keys is None or not os.path.exists(self.checkpoints.path('detect', keys['detect'])):
+                page.detect_image(self.detect_scale) # not needed when detection resumes from a checkpoint
+        return page_name(path, index), page
+
+    def page_indices(self, path):
+        if not self.all_pages:
+            return [0]
+        return list(range(count_pages(path)))
+
+    def write(self, extraction, origin_image, name, recognized):
+        path = self.write_xlsx(recognized, name)
+        if extraction.get('keys'):
+            self.checkpoints.mark_done(name, extraction['keys']['write'], [path] if path else [])
+        # visualization draws on the page in place, so it must come after OCR has read the table crops
+        if self.should_visualize():
+            self.visualize(extraction, origin_image, name)
+
+    def visualize_failure(self, extraction, origin_image, name):
+        if extraction is not None and self.should_visualize(failed=True):
+            self.visualize(extraction, origin_image, name, prefix='failed')
+
+    def run_page(self, path, index=0, digest=None):
+        name, origin_image, extraction = None, None, None
+        try:
+            name, origin_image = self.decode(path, index, digest)
+            extraction = self.extract_coordinate(origin_image)
+            self.write(extraction, origin_image, name, self.recognize(extraction))
+        except Exception:
+            self.visualize_failure(extraction, origin_image, name)
+            raise
+
+    def run(self, path, digest=None):
+        trace = self.tracer.begin(path)
+        try:
+            digest = digest or self.document_digest(path) # hashed once for all pages
+            for index in self.page_indices(path): # one page in memory at a time
+                self.tracer.count('pages')
+                self.run_page(path, index, digest)
+        except Exception:
+            self.tracer.end(trace, 'failed')
+            raise
+        self.tracer.end(trace)
+
+    def close(self):
+        '''
+        wait for pending asynchronous visualizations
+        '''
+        if self.visual_writer is not None:
+            self.visual_writer.close()
+
+    def run_pipelined(self, paths):
+        '''
+        run decode, detect, OCR and write of consecutive documents concurrently
+        yield one result dict per path, in input order
+        '''
+        return run_pipelined(self, paths, self.pipeline_depth)
 
 if __name__ == "__main__":
 
@@ -166,19 +495,16 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config_path', default='config.json', help='path to config')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--log', default=None, help='path to failure log (json lines)')
+    parser.add_argument('--trace', default=None, help='path to per-stage timing trace (json lines)')
     args = parser.parse_args()
     config = json.load(open(args.config_path))
-    converter = Converter(config)
+    if args.trace:
+        config["trace_path"] = args.trace
 
     DATA_DIR = config["data_dir"]
-    data = os.listdir(DATA_DIR)
-
-    for t in data:
-        try:
-            converter.run(os.path.join(DATA_DIR, t))
-        except:
-            print(t)
-
-
-
+    data = [os.path.join(DATA_DIR, t) for t in sorted(os.listdir(DATA_DIR))]
 
+    summary = run_batch(config, data, workers=args.workers, log_path=args.log)
+    print(json.dumps(summary, indent=4))
@@ -0,0 +1,143 @@
+"""
+content-addressed on-disk cache of per-file TEDS results
+"""
+import hashlib
+import json
+import os
+import shutil
+
+def file_digest(path, block_size=1 << 20):
+    if not path or not os.path.isfile(path):
+        return 'missing'
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def atomic_write(path, write):
+    '''
+    write(tmp path) writes the file, which then replaces path: concurrent processes never see a partial file
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.%d.tmp' % os.getpid()
+    write(tmp)
+    os.replace(tmp, path)
+
+class DiskStore:
+    '''
+    directory/<key[:2]>/<key><suffix> entries shared by runs and processes,
+    evict() removes the least recently used entries until the store fits in max_bytes
+    '''
+    suffix = ''
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.dir, key[:2], key + self.suffix)
+
+    def load(self, key, read):
+        '''
+        read(path) of the entry, None when it is missing or unreadable
+        '''
+        path = self.path(key)
+        try:
+            value = read(path)
+            os.utime(path, None) # mark as recently used
+        except (IOError, OSError, ValueError):
+            return None
+        return value
+
+    def store(self, key, write):
+        atomic_write(self.path(key), write)
+
+    def entries(self):
+        for dirpath, _, filenames in os.walk(self.dir):
+            for filename in filenames:
+                if filename.endswith(self.suffix):
+                    path = os.path.join(dirpath, filename)
+                    stat = os.stat(path)
+                    yield stat.st_mtime, stat.st_size, path
+
+    def evict(self):
+        '''
+        remove the least recently used entries until the store fits in max_bytes
+        return the number of removed entries
+        '''
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+class EvalCache(DiskStore):
+    suffix = '.json'
+
+    def __init__(self, cache_dir, version, max_bytes=1 << 30):
+        '''
+        cache_dir: root of the cache, entries of a metric version live in cache_dir/<version>
+        version: metric version, results of other versions are never read
+        max_bytes: size limit of the entries of this version, least recently used are evicted first
+        '''
+        self.root = os.path.abspath(cache_dir)
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        DiskStore.__init__(self, os.path.join(self.root, version), max_bytes)
+
+    def key(self, gt_path, pd_path, extension, ocr_included):
+        parts = [file_digest(gt_path), file_digest(pd_path), extension, str(bool(ocr_included)), self.version]
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        entry = self.load(key, read_json)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [entry['final'], entry['number_of_table'], entry['teds_list']]
+
+    def put(self, key, result):
+        final, num_tables, results = result
+        entry = {'final': final, 'number_of_table': num_tables, 'teds_list': results}
+        def write(tmp):
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+        self.store(key, write)
+
+    def invalidate(self, version=None):
+        '''
+        drop every entry of version (default: this cache's version)
+        '''
+        version = version or self.version
+        shutil.rmtree(os.path.join(self.root, version), ignore_errors=True)
+        if version == self.version:
+            os.makedirs(self.dir, exist_ok=True)
+
+    def invalidate_other_versions(self):
+        for version in os.listdir(self.root):
+            if version != self.version and os.path.isdir(os.path.join(self.root, version)):
+                self.invalidate(version)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits/float(total) if total else 0.
+        }
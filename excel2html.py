@@ -1,8 +1,9 @@
 #Create a function to process excel data
 #create another function to create html page
 #https://github.com/Knio/dominate/blob/master/README.md 
-import logging, dominate, openpyxl, sys, os
+import logging, dominate, sys, os
 from dominate.tags import *
+from xlsx_reader import load_active_table
 
 #setup logging Debug
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -17,22 +18,18 @@ def excel_sheet_processor(workbookfilepath: str):
         returns:
             list
     '''
-    #open workbook
-    wb = openpyxl.load_workbook(workbookfilepath)
-    #select active sheet
-    ws = wb.active
+    #read values of the active sheet without building an openpyxl workbook
+    values = load_active_table(workbookfilepath)['values']
     #define list
     workbook_list = []
     #define keys as a list
-    my_keys = []
-    for col in range(0, ws.max_column):
-        my_keys.append(ws.cell(row=1, column=col + 1).value)
+    my_keys = list(values[0])
     #define loop to convert rows to dictionaries
-    for row in range(2, ws.max_row+1):
+    for row_values in values[1:]:
             #create dictionary
             dictionary = {}
             for pos in range(0, len(my_keys)):
-                dictionary[my_keys[pos]] = ws.cell(row=row, column=pos+1).value
+                dictionary[my_keys[pos]] = row_values[pos]
             workbook_list.append(dictionary)
     return workbook_list
 
@@ -0,0 +1,151 @@
+"""
+per-stage timing of Converter documents, written as json lines
+"""
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+import numpy as np
+
+# cpu time of the calling thread (python >= 3.7), of the whole process otherwise
+cpu_time = getattr(time, 'thread_time', time.process_time)
+
+class NullStage:
+    '''
+    reusable no-op context manager (contextlib.nullcontext needs python 3.7)
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = NullStage()
+
+class NullTracer:
+    '''
+    tracer used when tracing is off, every call is a no-op
+    '''
+    enabled = False
+
+    def begin(self, name):
+        return None
+
+    def bind(self, trace):
+        pass
+
+    def stage(self, name):
+        return NULL_STAGE
+
+    def count(self, key, n=1):
+        pass
+
+    def end(self, trace, status='ok'):
+        pass
+
+class Tracer:
+    '''
+    records wall and cpu time per stage and counters for every document
+    the document being processed is bound per thread, so stages of different documents
+    can run concurrently (pipelined mode); cpu time is the time of the calling thread where
+    python provides it (3.7+), the time of the process otherwise
+    '''
+    enabled = True
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def begin(self, name):
+        trace = {'doc': name, 'start': time.perf_counter(), 'stages': dict(), 'counts': dict()}
+        self.local.trace = trace
+        return trace
+
+    def bind(self, trace):
+        self.local.trace = trace
+
+    @contextmanager
+    def stage(self, name):
+        trace = getattr(self.local, 'trace', None)
+        wall = time.perf_counter()
+        cpu = cpu_time()
+        try:
+            yield
+        finally:
+            if trace is not None:
+                record = trace['stages'].setdefault(name, {'wall': 0., 'cpu': 0., 'calls': 0})
+                record['wall'] += time.perf_counter() - wall
+                record['cpu'] += cpu_time() - cpu
+                record['calls'] += 1
+
+    def count(self, key, n=1):
+        trace = getattr(self.local, 'trace', None)
+        if trace is not None:
+            trace['counts'][key] = trace['counts'].get(key, 0) + n
+
+    def end(self, trace, status='ok'):
+        if trace is None:
+            return
+        trace['wall'] = time.perf_counter() - trace.pop('start')
+        trace['status'] = status
+        line = json.dumps(trace) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f: # one write per document, workers can share the file
+                f.write(line)
+
+def make_tracer(path):
+    if path:
+        return Tracer(path)
+    return NullTracer()
+
+def summarize_trace(path, percentiles=(50, 90, 99)):
+    '''
+    roll the json lines of a trace file up into per-stage statistics of the per-document wall time
+    '''
+    docs = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                docs.append(json.loads(line))
+    stages = dict()
+    for doc in docs:
+        for name, record in doc['stages'].items():
+            stages.setdefault(name, []).append(record['wall'])
+    totals = [doc['wall'] for doc in docs]
+    summary = {
+        'documents': len(docs),
+        'failed': sum(1 for doc in docs if doc.get('status') != 'ok'),
+        'counts': dict(),
+        'stages': dict()
+    }
+    for doc in docs:
+        for key, n in doc['counts'].items():
+            summary['counts'][key] = summary['counts'].get(key, 0) + n
+    all_time = float(np.sum(totals)) if totals else 0.
+    for name, walls in list(stages.items()) + [('document', totals)]:
+        if not walls:
+            continue
+        walls = np.asarray(walls)
+        stat = {'docs': len(walls), 'mean': float(walls.mean()), 'total': float(walls.sum())}
+        for p in percentiles:
+            stat['p%d' % p] = float(np.percentile(walls, p))
+        stat['share'] = stat['total']/all_time if all_time > 0 else 0.
+        summary['stages'][name] = stat
+    return summary
+
+def format_summary(summary):
+    lines = ['%d documents, %d failed' % (summary['documents'], summary['failed'])]
+    keys = [key for key in next(iter(summary['stages'].values()), {}) if key.startswith('p')]
+    lines.append('%-16s %6s %9s ' % ('stage', 'docs', 'mean') + ' '.join('%9s' % k for k in keys) + ' %10s %6s' % ('total', 'share'))
+    ordered = sorted(summary['stages'].items(), key=lambda item: (item[0] == 'document', -item[1]['total']))
+    for name, stat in ordered:
+        lines.append(
+            '%-16s %6d %8.3fs ' % (name, stat['docs'], stat['mean'])
+            + ' '.join('%8.3fs' % stat[k] for k in keys)
+            + ' %9.1fs %5.1f%%' % (stat['total'], 100 * stat['share'])
+        )
+    return '\n'.join(lines)
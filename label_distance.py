@@ -0,0 +1,119 @@
+"""
+cached label distance for the tree edit distance of tables
+"""
+from collections import OrderedDict
+import time
+
+import textdistance
+
+def myers_levenshtein(a, b):
+    '''
+    bit-parallel levenshtein distance (Myers / Hyyro), one machine word per column when len(a) <= 64
+    '''
+    m = len(a)
+    if m == 0:
+        return len(b)
+    peq = dict()
+    for i, c in enumerate(a):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv = full
+    mv = 0
+    score = m
+    for c in b:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = ((((eq & pv) + pv) & full) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & full
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = (mh | ~(xv | ph)) & full
+        mv = ph & xv
+    return score
+
+class LabelDistance:
+    def __init__(self, maxsize=1 << 16, max_bitparallel=64):
+        '''
+        maxsize: number of label pairs kept in the LRU cache
+        max_bitparallel: longest string (shorter side) handled by the bit-parallel levenshtein
+        '''
+        self.maxsize = maxsize
+        self.max_bitparallel = max_bitparallel
+        self.ids = dict() # interned labels
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bitparallel = 0
+        self.fallback = 0
+        self.compute_time = 0.
+
+    def intern(self, label):
+        idx = self.ids.get(label, None)
+        if idx is None:
+            idx = len(self.ids)
+            self.ids[label] = idx
+        return idx
+
+    def compute(self, label_1, label_2):
+        if isinstance(label_1, str) and isinstance(label_2, str):
+            if len(label_2) < len(label_1):
+                label_1, label_2 = label_2, label_1
+            if len(label_1) <= self.max_bitparallel:
+                self.bitparallel += 1
+                maximum = len(label_2)
+                if maximum == 0:
+                    return 0.
+                # same arithmetic as 1 - levenshtein.normalized_similarity
+                return 1. - (1 - myers_levenshtein(label_1, label_2)/maximum)
+        self.fallback += 1
+        return 1. - textdistance.levenshtein.normalized_similarity(label_1, label_2)
+
+    def __call__(self, label_1, label_2):
+        # keep the intern table bounded as well, reset before interning so both ids are from the same table
+        if len(self.ids) + 2 > 4 * self.maxsize:
+            self.ids.clear()
+            self.cache.clear()
+        a = self.intern(label_1)
+        b = self.intern(label_2)
+        key = (a, b) if a <= b else (b, a) # levenshtein is symmetric
+        dist = self.cache.get(key, None)
+        if dist is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return dist
+        self.misses += 1
+        start = time.perf_counter()
+        dist = self.compute(label_1, label_2)
+        self.compute_time += time.perf_counter() - start
+        self.cache[key] = dist
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return dist
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits/float(total) if total else 0.,
+            'bitparallel': self.bitparallel,
+            'fallback': self.fallback,
+            'compute_time': self.compute_time,
+            'cache_size': len(self.cache),
+            'interned': len(self.ids)
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.bitparallel = 0
+        self.fallback = 0
+        self.compute_time = 0.
+
+LABEL_DISTANCE = LabelDistance()
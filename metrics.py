@@ -1,17 +1,24 @@
 from openpyxl import load_workbook, Workbook
 from openpyxl.utils.cell import coordinate_from_string, column_index_from_string
 from zss import simple_distance, Node, distance
-import textdistance
+from label_distance import LABEL_DISTANCE
+from eval_cache import EvalCache
+from xlsx_reader import load_tables
+from table_tree import LabelTable, TableTree
 from functools import cmp_to_key
+import numpy as np
 
 import os
 import argparse
 import json
 from glob import glob
+from multiprocessing import Pool
 
 from rndtable.utils import load_json, cal_spec_location_iou, combine_text_list, stand2spec_output
 from rndtable.visualize import visualize_bar_chart, dump_report_excel
 
+METRIC_VERSION = 'teds-3' # bump when the scores of unchanged files can change
+
 class WeirdNode(Node):
     def __init__(self, label, rowspan, colspan):
         super(WeirdNode, self).__init__(label, children=None)
@@ -27,7 +34,7 @@ class WeirdNode(Node):
     
     @staticmethod
     def label_dist(label_1, label_2):
-        return 1. - textdistance.levenshtein.normalized_similarity(label_1, label_2)
+        return LABEL_DISTANCE(label_1, label_2)
     
     @staticmethod
     def insert_cost(node):
@@ -58,52 +65,67 @@ class WeirdNode(Node):
             self.children.append(node)
         return self
 
-def convert_sheet2tree(sheet, ocr_included=True):
+def index_merged(bounds_list):
+    '''
+    bounds_list: (min_col, min_row, max_col, max_row) of every merged range, 1-based
+    return the spans keyed by the 0-based (row, col) of the top-left cell and the set of the other cells of the ranges
+    '''
+    spans = dict()
+    covered = set()
+    for bounds in bounds_list:
+        # rowspan/colspan keep the reading of bounds the TEDS scores have always been computed with
+        start_col, start_row, end_row, end_col = bounds
+        min_col, min_row, max_col, max_row = bounds
+        spans.setdefault((min_row - 1, min_col - 1), (end_row - start_row + 1, end_col - start_col + 1))
+        for r in range(min_row - 1, max_row):
+            for c in range(min_col - 1, max_col):
+                if (r, c) != (min_row - 1, min_col - 1):
+                    covered.add((r, c))
+    return spans, covered
+
+def index_sheet(sheet):
+    '''
+    read an openpyxl worksheet (or a table from xlsx_reader) once:
+    title, rows of values, merged spans and cells covered by merges
+    '''
+    if isinstance(sheet, dict):
+        spans, covered = index_merged(sheet['merged'])
+        return sheet['title'], sheet['values'], spans, covered
+    values = list(sheet.iter_rows(min_row=1, max_row=sheet.max_row, min_col=1, max_col=sheet.max_column, values_only=True))
+    spans, covered = index_merged([rng.bounds for rng in sheet.merged_cells.ranges])
+    return sheet.title, values, spans, covered
+
+def build_sheet_tree(title, values, spans, covered, ocr_included=True, label_table=None):
     def set_node_label(label):
         if ocr_included:
             return label
-        return sheet.title
-        
+        return title
+
+    def is_empty(value):
+        return value == None or str(value).strip() == ''
+
     conv = lambda i : i or ''
-    tree = WeirdNode(set_node_label(sheet.title), None, None)
-    merged_ranges = sheet.merged_cells.ranges.copy()
-    for row in range(0, sheet.max_row):
-        node = WeirdNode(set_node_label('row_' + str(row+1)), None, None)
-        for col in range(0, sheet.max_column):
-            cell = sheet.cell(row=row+1, column=col+1)
-            if type(cell).__name__ != 'MergedCell':
-                if cell.value == None or str(cell.value).strip() == '': # check if the cell is the last one with not None value
-                    last = True
-                    for colu in range(col+1, sheet.max_column):
-                        if sheet.cell(row+1, colu+1).value != None and str(sheet.cell(row+1, colu+1).value).strip() != '':
-                            last = False
-                    if last:
-                        break
-                
-                is_merged = False
-                for mergedCell in merged_ranges:
-                    if (cell.coordinate in mergedCell):
-                        is_merged = True
-                        start_col, start_row, end_row, end_col = mergedCell.bounds
-                        rowspan = end_row - start_row + 1
-                        colspan = end_col - start_col + 1
-                        node = node.addkid(
-                            WeirdNode(
-                                set_node_label(conv(cell.value)), rowspan, colspan
-                            )
-                        )
-                        merged_ranges.remove(mergedCell)
-                        break
-                if not is_merged:
-                    node = node.addkid(
-                        WeirdNode(
-                            set_node_label(conv(cell.value)), 1, 1
-                        )
-                    )           
-        tree = tree.addkid(node)
-    return (tree)
-
-def convert_json2tree(json_table, name, ocr_included=True):
+    tree = TableTree(set_node_label(title), label_table)
+    for row, row_values in enumerate(values):
+        last = -1 # last column with a value
+        for col, value in enumerate(row_values):
+            if (row, col) not in covered and not is_empty(value):
+                last = col
+        tree.add_row(set_node_label('row_' + str(row+1)))
+        for col, value in enumerate(row_values):
+            if (row, col) in covered: # MergedCell
+                continue
+            if is_empty(value) and last < col: # the rest of the row is empty
+                break
+            rowspan, colspan = spans.get((row, col), (1, 1))
+            tree.add_cell(set_node_label(conv(value)), rowspan, colspan)
+    return tree.freeze()
+
+def convert_sheet2tree(sheet, ocr_included=True, label_table=None):
+    title, values, spans, covered = index_sheet(sheet)
+    return build_sheet_tree(title, values, spans, covered, ocr_included, label_table)
+
+def convert_json2tree(json_table, name, ocr_included=True, label_table=None):
     def compare_location(cell1, cell2):
         if cell1['rows'][0] == cell2['rows'][0]:
             return cell1['columns'][0] - cell2['columns'][0]
@@ -120,26 +142,42 @@ def convert_json2tree(json_table, name, ocr_included=True):
 
     cell_list = sort_cell_list(json_table["cell_list"])
     conv = lambda i : i or ''
-    tree = WeirdNode(set_node_label(name), None, None)
+    tree = TableTree(set_node_label(name), label_table)
     row = 0
-    node = WeirdNode(set_node_label('row_' + str(row+1)), None, None)
+    row_label = set_node_label('row_' + str(row+1))
+    cells = [] # cells of the current row, a row only enters the tree when the next one starts
     for idx, lay in enumerate(cell_list):
         if lay['rows'][0] != row:
-            tree = tree.addkid(node)
+            tree.add_row(row_label)
+            for cell in cells:
+                tree.add_cell(*cell)
             row = lay['rows'][0]
-            node = WeirdNode(set_node_label('row_' + str(row+1)), None, None)
+            row_label = set_node_label('row_' + str(row+1))
+            cells = []
 
         start_row, end_row, start_col, end_col = lay['rows'] + lay['columns']
         rowspan = end_row - start_row + 1
         colspan = end_col - start_col + 1
-        node = node.addkid(
-            WeirdNode(
-                set_node_label(conv(combine_text_list(lay['text_list']))), rowspan, colspan
-            )
-        )
-    return (tree)
+        cells.append((set_node_label(conv(combine_text_list(lay['text_list']))), rowspan, colspan))
+    return tree.freeze()
+
+def to_weird_node(tree):
+    '''
+    WeirdNode version of a TableTree, for zss and older callers
+    '''
+    if isinstance(tree, WeirdNode):
+        return tree
+    root = WeirdNode(tree.label_table[tree.title], None, None)
+    for row_label, cells in tree.rows():
+        node = WeirdNode(row_label, None, None)
+        for label, rowspan, colspan in cells:
+            node.addkid(WeirdNode(label, rowspan, colspan))
+        root.addkid(node)
+    return root
 
 def get_num_nodes(tree):
+    if isinstance(tree, TableTree):
+        return tree.num_nodes()
     t = len(WeirdNode.get_children(tree))
     t += sum([len(WeirdNode.get_children(node)) for node in WeirdNode.get_children(tree) ])
     return t
@@ -149,75 +187,236 @@ def cal_edit_distance(Ta, Tb):
     Ta, Tb: trees
     '''
     return distance(
-        Ta, 
-        Tb,
+        to_weird_node(Ta), 
+        to_weird_node(Tb),
         get_children=WeirdNode.get_children,
         insert_cost=WeirdNode.insert_cost,
         remove_cost=WeirdNode.remove_cost,
         update_cost=WeirdNode.update_cost
     )
 
-def cal_TEDS(Ta, Tb):
+def get_leaves(tree):
+    '''
+    leaves of a root -> rows -> cells tree from left to right, a row without cells is a leaf itself
+    '''
+    rows = WeirdNode.get_children(tree)
+    if len(rows) == 0:
+        return [tree]
+    leaves = []
+    for row in rows:
+        cells = WeirdNode.get_children(row)
+        if len(cells) == 0:
+            leaves.append(row)
+        else:
+            leaves.extend(cells)
+    return leaves
+
+def leaf_sequence(tree):
+    '''
+    labels and (rowspan, colspan) of the leaves of a TableTree or a WeirdNode tree
+    '''
+    if isinstance(tree, TableTree):
+        return tree.leaves()
+    leaves = get_leaves(tree)
+    return [leaf.get_label() for leaf in leaves], [(leaf.rowspan, leaf.colspan) for leaf in leaves]
+
+def leaf_arrays(tree, label_table):
+    '''
+    label ids in label_table, rowspans and colspans (-1 for leaves that are not cells) of the leaves of a tree
+    '''
+    if isinstance(tree, TableTree) and tree.label_table is label_table:
+        return tree.leaf_arrays()
+    labels, spans = leaf_sequence(tree)
+    ids = np.array([label_table.intern(label) for label in labels], dtype=np.int64)
+    rowspans = np.array([-1 if rowspan is None else rowspan for rowspan, _ in spans], dtype=np.int64)
+    colspans = np.array([-1 if colspan is None else colspan for _, colspan in spans], dtype=np.int64)
+    return ids, rowspans, colspans
+
+def fast_edit_distance(Ta, Tb):
+    '''
+    Ta, Tb: root -> rows -> cells trees (TableTree or WeirdNode)
+    same value as cal_edit_distance: inner nodes are inserted and removed for free while updating them
+    costs 1, so an optimal mapping only pairs leaves and the tree edit distance is the alignment of the
+    2 leaf sequences (insert/remove 1, update WeirdNode.update_cost), computed one row of the DP at a time
+    label distances are cached on the label ids of the LabelTable shared by TableTrees built together
+    '''
+    shared = isinstance(Ta, TableTree) and isinstance(Tb, TableTree) and Ta.label_table is Tb.label_table
+    label_table = Ta.label_table if shared else LabelTable()
+    ids_a, rowspans_a, colspans_a = leaf_arrays(Ta, label_table)
+    ids_b, rowspans_b, colspans_b = leaf_arrays(Tb, label_table)
+    m = len(ids_b)
+    span_ids = dict()
+    span_b = np.array([
+        span_ids.setdefault(span, len(span_ids)) for span in zip(rowspans_b.tolist(), colspans_b.tolist())
+    ], dtype=int)
+    groups = dict() # span id -> positions in leaves of b
+    for idx in span_ids.values():
+        groups[idx] = np.nonzero(span_b == idx)[0]
+    labels_b = ids_b.tolist()
+    dists = dict() # (label id, span id) -> label distances to the leaves of b with that span
+
+    cols = np.arange(m + 1, dtype=float)
+    prev = cols.copy()
+    for i, (label, span) in enumerate(zip(ids_a.tolist(), zip(rowspans_a.tolist(), colspans_a.tolist())), 1):
+        cost = np.ones(m)
+        span = span_ids.get(span, None)
+        if span is not None:
+            key = (label, span)
+            if key not in dists:
+                dists[key] = np.array([label_table.distance(label, labels_b[j]) for j in groups[span]], dtype=float)
+            cost[groups[span]] = dists[key]
+        tmp = np.empty(m + 1)
+        tmp[0] = i
+        tmp[1:] = np.minimum(prev[1:] + 1, prev[:-1] + cost)
+        prev = np.minimum.accumulate(tmp - cols) + cols # insertions along the row
+    return float(prev[-1])
+
+def cal_TEDS(Ta, Tb, engine='fast'):
     '''
     Ta, Tb: trees
+    engine: 'fast' for the leaf alignment, 'zss' for the generic Zhang-Shasha reference
     '''
     denominator = 1 + max(get_num_nodes(Ta), get_num_nodes(Tb))
-    return 1. - (cal_edit_distance(Ta, Tb)/float(denominator))
+    if engine == 'zss':
+        dist = cal_edit_distance(Ta, Tb)
+    else:
+        dist = fast_edit_distance(Ta, Tb)
+    return 1. - (dist/float(denominator))
 
 def compare_tables(table1, table2, name=None, ocr_included=True):
+    label_table = LabelTable() # labels of this pair only, released with the trees
     if name:
-        Ta = convert_json2tree(table1, name, ocr_included)
-        Tb = convert_json2tree(table2, name, ocr_included)
+        Ta = convert_json2tree(table1, name, ocr_included, label_table)
+        Tb = convert_json2tree(table2, name, ocr_included, label_table)
     else:
-        Ta = convert_sheet2tree(table1, ocr_included)
-        Tb = convert_sheet2tree(table2, ocr_included)
+        Ta = convert_sheet2tree(table1, ocr_included, label_table)
+        Tb = convert_sheet2tree(table2, ocr_included, label_table)
     return cal_TEDS(Ta, Tb)
 
-def compare_excels(gt_path, pd_path, ocr_included=True):
+def compare_excels(gt_path, pd_path, ocr_included=True, streaming=True):
+    '''
+    streaming: read values and merged ranges with xlsx_reader instead of loading full openpyxl workbooks
+    '''
+    if streaming:
+        load = lambda path: load_tables(path)
+        titles = lambda tables: [table['title'] for table in tables]
+    else:
+        load = lambda path: load_workbook(path).worksheets
+        titles = lambda sheets: [sheet.title for sheet in sheets]
+
     apath = os.path.abspath(gt_path)
-    gt_wb = load_workbook(apath)
+    gt_sheets = load(apath)
     if not pd_path or not os.path.isfile(pd_path):
-        return [0., len(gt_wb.worksheets), len(gt_wb.worksheets)*[0.]]
+        return [0., len(gt_sheets), len(gt_sheets)*[0.]]
 
     bpath = os.path.abspath(pd_path)
-    pd_wb = load_workbook(bpath)
+    pd_sheets = load(bpath)
+    pd_by_name = dict()
+    for title, sheet in zip(titles(pd_sheets), pd_sheets):
+        pd_by_name.setdefault(title, sheet)
     final = 0. # final is sum of all TEDS scores (not average) 
     results = []
     
-    for idx, gt_sheet in enumerate(gt_wb.worksheets):
-        name = gt_sheet.title
-        if name in pd_wb.sheetnames:
-            pd_sheet = pd_wb[name]
+    for idx, (name, gt_sheet) in enumerate(zip(titles(gt_sheets), gt_sheets)):
+        if name in pd_by_name:
+            pd_sheet = pd_by_name[name]
             res = compare_tables(gt_sheet, pd_sheet, ocr_included=ocr_included)
         else:
             res = 0.
         results.append(res)
         final += res
-    return [final, len(gt_wb.worksheets), results]
+    return [final, len(gt_sheets), results]
+
+def location_boxes(tables):
+    '''
+    (N, 4) array of x0, y0, x1, y1 enclosing the corner points of every table location
+    ValueError when a location is not a list of (x, y) points
+    '''
+    boxes = np.zeros((len(tables), 4))
+    for idx, table in enumerate(tables):
+        points = np.asarray(table["location"], dtype=float)
+        if points.ndim != 2 or points.shape[1] != 2 or len(points) == 0:
+            raise ValueError('location is not a list of points: %r' % (table["location"],))
+        boxes[idx, :2] = points.min(axis=0)
+        boxes[idx, 2:] = points.max(axis=0)
+    return boxes
+
+def overlap_matrix(gt_boxes, pd_boxes):
+    '''
+    True for every gt / pd pair whose boxes overlap or touch (inclusive pixel coordinates share the border)
+    '''
+    iw = np.minimum(gt_boxes[:, None, 2], pd_boxes[None, :, 2]) - np.maximum(gt_boxes[:, None, 0], pd_boxes[None, :, 0])
+    ih = np.minimum(gt_boxes[:, None, 3], pd_boxes[None, :, 3]) - np.maximum(gt_boxes[:, None, 1], pd_boxes[None, :, 1])
+    return (iw >= 0) & (ih >= 0)
+
+def scan_tables(gt_data, pd_data, candidates=None):
+    '''
+    for every gt table, (index of the pd table with the highest cal_spec_location_iou, that IoU),
+    (0, 0.) when nothing overlaps; candidates: boolean (gt, pd) matrix of the pairs to score, all by default
+    '''
+    matches = []
+    for idx, gt_table in enumerate(gt_data):
+        max_iou = 0.
+        max_jdx = 0
+        jdxs = range(len(pd_data)) if candidates is None else np.flatnonzero(candidates[idx])
+        for jdx in jdxs:
+            iou = cal_spec_location_iou(gt_table["location"], pd_data[jdx]["location"])
+            if iou > max_iou:
+                max_iou = iou
+                max_jdx = int(jdx)
+        matches.append((max_jdx, float(max_iou)))
+    return matches
+
+def match_tables(gt_data, pd_data):
+    '''
+    same matches as scan_tables: the bounding boxes of the locations only prune the pairs that can't overlap,
+    the other pairs are scored with cal_spec_location_iou; see check_match_tables
+    '''
+    if len(gt_data) == 0 or len(pd_data) == 0:
+        return scan_tables(gt_data, pd_data)
+    try:
+        candidates = overlap_matrix(location_boxes(gt_data), location_boxes(pd_data))
+    except ValueError: # locations of another form, every pair is scored
+        candidates = None
+    return scan_tables(gt_data, pd_data, candidates)
+
+def load_json_pair(gt_path, pd_path):
+    '''
+    gt tables converted to spec output and pd tables as stored, pd is None when there is no prediction
+    '''
+    gt_data = stand2spec_output(load_json(os.path.abspath(gt_path)))
+    if not pd_path or not os.path.isfile(pd_path):
+        return gt_data, None
+    return gt_data, load_json(os.path.abspath(pd_path))
+
+def check_match_tables(gt_dir, pd_dir, tolerance=1e-6):
+    '''
+    compare match_tables with scan_tables on every json pair of gt_dir / pd_dir
+    return the mismatches as (file name, gt table index, reference match, match)
+    '''
+    mismatches = []
+    for gt_path in sorted(glob(os.path.abspath(gt_dir) + '/*.json')):
+        name = os.path.basename(gt_path)
+        gt_data, pd_data = load_json_pair(gt_path, os.path.join(pd_dir, name))
+        if pd_data is None:
+            continue
+        for idx, (ref, new) in enumerate(zip(scan_tables(gt_data, pd_data), match_tables(gt_data, pd_data))):
+            if ref[0] != new[0] or abs(ref[1] - new[1]) > tolerance:
+                mismatches.append((name, idx, ref, new))
+    return mismatches
 
 def compare_jsons(gt_path, pd_path, ocr_included=True, threshold=0.8):
     """
     gt_path and pd_path are json files with spec io
     """
-    apath = os.path.abspath(gt_path)
-    gt_data = load_json(apath)
-    gt_data = stand2spec_output(gt_data)
-    if not pd_path or not os.path.isfile(pd_path):
+    gt_data, pd_data = load_json_pair(gt_path, pd_path)
+    if pd_data is None:
         return [0., len(gt_data), len(gt_data)*[0.]]
 
-    bpath = os.path.abspath(pd_path)
-    pd_data = load_json(bpath)
     final = 0.
     results = []
-    for idx, gt_table in enumerate(gt_data):
+    for idx, (gt_table, (max_jdx, max_iou)) in enumerate(zip(gt_data, match_tables(gt_data, pd_data))):
         name = 'table_' + str(idx+1)
-        max_iou = 0.
-        max_jdx = 0
-        for jdx, pd_table in enumerate(pd_data):
-            iou = cal_spec_location_iou(gt_table["location"], pd_table["location"])
-            if iou > max_iou:
-                max_iou = iou
-                max_jdx = jdx
         if max_iou > threshold:
             pd_table = pd_data[max_jdx]
             res = compare_tables(gt_table, pd_table, name, ocr_included=ocr_included)
@@ -227,13 +426,41 @@ def compare_jsons(gt_path, pd_path, ocr_included=True, threshold=0.8):
         final += res
     return [final, len(gt_data), results]
 
-def compare(gt_dir, pd_dir, output_dir, extension='json', ocr_included=True):
+def compare_file(task):
+    '''
+    task: (index, gt path, pd path, extension, ocr_included), run in pool workers
+    '''
+    idx, gt_path, pd_path, extension, ocr_included = task
     if extension == 'xlsx':
         cmp_func = compare_excels
-    elif extension == 'json':
-        cmp_func = compare_jsons
     else:
-        assert 1, "Wrong extension ! Extension must be json or xlsx"
+        cmp_func = compare_jsons
+    return idx, cmp_func(gt_path, pd_path, ocr_included)
+
+def file_cost(gt_path, pd_path):
+    size = os.path.getsize(gt_path)
+    if os.path.isfile(pd_path):
+        size += os.path.getsize(pd_path)
+    return size
+
+def compare_files(tasks, workers=1, chunksize=4):
+    '''
+    run compare_file over tasks and return the results in task order
+    the largest files are scheduled first so that they don't end up as stragglers
+    '''
+    if workers <= 1:
+        return [compare_file(task)[1] for task in tasks]
+    order = sorted(tasks, key=lambda task: (-file_cost(task[1], task[2]), task[0]))
+    results = dict()
+    with Pool(workers) as pool:
+        for idx, res in pool.imap_unordered(compare_file, order, chunksize):
+            results[idx] = res
+    return [results[task[0]] for task in tasks]
+
+def compare(gt_dir, pd_dir, output_dir, extension='json', ocr_included=True, workers=1, chunksize=4,
+            cache_dir=None, cache_bytes=1 << 30):
+    if extension not in ('xlsx', 'json'): # checked before any file is dispatched to a worker
+        raise ValueError("Wrong extension %r ! Extension must be json or xlsx" % (extension,))
 
     gt_dir = os.path.abspath(gt_dir)
     filepaths = glob(gt_dir + '/*')
@@ -243,11 +470,29 @@ def compare(gt_dir, pd_dir, output_dir, extension='json', ocr_included=True):
     mode = dict()
     n_sheets = 0
     summary = []
+
+    tasks = [
+        (idx, filepath, os.path.join(pd_dir, os.path.basename(filepath)), extension, ocr_included)
+        for idx, filepath in enumerate(filepaths)
+    ]
+    file_results = [None] * len(tasks)
+    if cache_dir:
+        # only pairs whose gt or pd content changed since the last run are evaluated again
+        cache = EvalCache(cache_dir, METRIC_VERSION, cache_bytes)
+        keys = [cache.key(task[1], task[2], extension, ocr_included) for task in tasks]
+        file_results = [cache.get(key) for key in keys]
+    pending = [task for task in tasks if file_results[task[0]] is None]
+    for task, res in zip(pending, compare_files(pending, workers, chunksize)):
+        file_results[task[0]] = res
+        if cache_dir:
+            cache.put(keys[task[0]], res)
+    if cache_dir:
+        cache.evict()
+    # results are merged in the order of filepaths, so sums and the report match a serial run
     
     for idx, filepath in enumerate(filepaths):
         filename = os.path.basename(filepath)
-        pd_path = os.path.join(pd_dir, filename)
-        final, num_tables, results = cmp_func(filepath, pd_path, ocr_included)        
+        final, num_tables, results = file_results[idx]
         for res in results:
             mode[str(round(res,1))] = mode.get(str(round(res,1)), 0) + 1
             if TEDS_max < res:
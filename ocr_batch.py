@@ -0,0 +1,80 @@
+"""
+batched OCR over layout crops
+"""
+import logging
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+_unbatched = set() # model classes already reported as running crop by crop
+
+def ink_integral(image, ink_level=128):
+    '''
+    integral image of the dark pixels of image: (h+1, w+1), ink in [y0:y1, x0:x1] is
+    I[y1, x1] - I[y0, x1] - I[y1, x0] + I[y0, x0]
+    '''
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    return cv2.integral((gray < ink_level).astype(np.uint8))
+
+def ink_density(integral, bbox):
+    '''
+    fraction of dark pixels inside bbox (x0, y0, x1, y1), clipped to the image
+    '''
+    h, w = integral.shape[0] - 1, integral.shape[1] - 1
+    x0, y0, x1, y1 = bbox
+    x0, x1 = min(max(x0, 0), w), min(max(x1, 0), w)
+    y0, y1 = min(max(y0, 0), h), min(max(y1, 0), h)
+    area = (x1 - x0) * (y1 - y0)
+    if area <= 0:
+        return 0.
+    ink = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    return ink / float(area)
+
+def crop_bucket(crop, bucket_size=16):
+    h, w = crop.shape[:2]
+    return (h + bucket_size - 1)//bucket_size, (w + bucket_size - 1)//bucket_size
+
+def make_batches(crops, batch_size=32, bucket_size=16):
+    '''
+    group indices of non-empty crops into batches of crops with the same height bucket,
+    sorted by width inside a bucket so that padding inside a batch stays small
+    '''
+    order = [idx for idx, crop in enumerate(crops) if crop.size != 0]
+    order.sort(key=lambda idx: crop_bucket(crops[idx], bucket_size))
+    batches = []
+    batch = []
+    key = None
+    for idx in order:
+        h_bucket = crop_bucket(crops[idx], bucket_size)[0]
+        if batch and (h_bucket != key or len(batch) == batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+        key = h_bucket
+    if batch:
+        batches.append(batch)
+    return batches
+
+def batch_ocr(ocr_model, crops, batch_size=32, bucket_size=16):
+    '''
+    crops: list of images (possibly from several tables or pages)
+    return the list of texts in the same order as crops, empty crops give ''
+    only a model with process_batch(list of images) -> list of fields runs one forward pass per batch,
+    otherwise every crop is a forward pass of its own and batch_size has no effect on speed
+    '''
+    texts = [''] * len(crops)
+    process_batch = getattr(ocr_model, 'process_batch', None)
+    if process_batch is None and type(ocr_model) not in _unbatched:
+        _unbatched.add(type(ocr_model))
+        logger.warning('%s has no process_batch, OCR runs one crop at a time (ocr_batch_size has no effect)',
+                       type(ocr_model).__name__)
+    for batch in make_batches(crops, batch_size, bucket_size):
+        images = [crops[idx] for idx in batch]
+        if process_batch is not None:
+            fields = process_batch(images)
+        else: # model without a batch api, keep the grouping but run crop by crop
+            fields = [ocr_model.process(img) for img in images]
+        for idx, field in zip(batch, fields):
+            texts[idx] = field['text']
+    return texts
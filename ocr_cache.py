@@ -0,0 +1,152 @@
+"""
+content-addressed cache of OCR results: in-memory LRU in front of an on-disk store
+"""
+from collections import OrderedDict
+import hashlib
+import os
+
+import cv2
+import numpy as np
+
+from eval_cache import DiskStore, file_digest
+
+KEY_HEIGHT = 32 # height of the normalized crop that is hashed
+MIN_CONTRAST = 24 # gray levels between the lightest and darkest pixel below which a crop has no key
+
+def normalize_crop(crop, height=KEY_HEIGHT, min_contrast=MIN_CONTRAST):
+    '''
+    binarized ink of the crop, trimmed to its bounding box and resized to `height`,
+    so that re-scans and crops shifted inside a white margin give the same image
+    None for a crop without contrast, its binarization would be noise
+    '''
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY) if crop.ndim == 3 else crop
+    if int(gray.max()) - int(gray.min()) < min_contrast:
+        return None
+    # otsu threshold follows the brightness and contrast of the scan, faint text is still ink
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    ink = ink[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    width = max(1, int(round(ink.shape[1] * height / float(ink.shape[0]))))
+    small = cv2.resize(ink, (width, height), interpolation=cv2.INTER_AREA)
+    return (small >= 128).astype(np.uint8)
+
+def crop_key(crop, height=KEY_HEIGHT, min_contrast=MIN_CONTRAST):
+    '''
+    hash of the normalized crop, see normalize_crop; None when the crop must not be cached
+    '''
+    norm = normalize_crop(crop, height, min_contrast)
+    if norm is None:
+        return None
+    norm = np.ascontiguousarray(norm)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((norm.shape, height)).encode('utf-8'))
+    h.update(norm.data)
+    return h.hexdigest()
+
+def read_text(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+class OCRCache(DiskStore):
+    suffix = '.txt'
+
+    def __init__(self, cache_dir, identity, max_bytes=1 << 30, memory_items=100000):
+        '''
+        cache_dir: root of the cache, shared by runs and worker processes
+        identity: identity of the OCR weights, entries of other weights live in other directories
+        max_bytes: size limit of the on-disk entries of this identity, enforced by evict()
+        memory_items: number of entries kept in memory
+        '''
+        self.root = os.path.abspath(cache_dir)
+        self.identity = identity
+        self.memory_items = memory_items
+        self.memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.uncached = 0
+        DiskStore.__init__(self, os.path.join(self.root, identity[:16]), max_bytes)
+
+    @classmethod
+    def for_weights(cls, cache_dir, weight_path, **kwargs):
+        return cls(cache_dir, file_digest(weight_path), **kwargs)
+
+    def remember(self, key, text):
+        self.memory[key] = text
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        text = self.memory.get(key, None)
+        if text is not None:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return text
+        text = self.load(key, read_text)
+        if text is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self.remember(key, text)
+        return text
+
+    def put(self, key, text):
+        self.remember(key, text)
+        def write(tmp):
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(text)
+        self.store(key, write)
+
+    def recognize(self, crops, ocr):
+        '''
+        texts of crops, ocr(list of crops) -> list of texts runs once over the distinct missing crops
+        empty crops give '' like batch_ocr, crops without a key are recognized but not cached
+        '''
+        texts = [''] * len(crops)
+        missing = OrderedDict() # key -> indices of the crops with that key
+        for idx, crop in enumerate(crops):
+            if crop.size == 0:
+                continue
+            key = crop_key(crop)
+            if key is None:
+                self.uncached += 1
+                missing[idx] = [idx] # an int is never a cache key
+                continue
+            text = self.get(key)
+            if text is None:
+                missing.setdefault(key, []).append(idx)
+            else:
+                texts[idx] = text
+        if missing:
+            results = ocr([crops[indices[0]] for indices in missing.values()])
+            for (key, indices), text in zip(missing.items(), results):
+                if not isinstance(key, int):
+                    self.put(key, text)
+                for idx in indices:
+                    texts[idx] = text
+        return texts
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'uncached': self.uncached,
+            'hit_rate': hits/float(total) if total else 0.
+        }
+
+def merge_stats(stats_list):
+    '''
+    sum the stats of several caches (one per worker process)
+    '''
+    merged = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'uncached': 0}
+    for stats in stats_list:
+        for key in merged:
+            merged[key] += stats[key]
+    total = merged['memory_hits'] + merged['disk_hits'] + merged['misses']
+    merged['hit_rate'] = (merged['memory_hits'] + merged['disk_hits'])/float(total) if total else 0.
+    return merged
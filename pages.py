@@ -0,0 +1,92 @@
+"""
+lazily decoded document pages: a reduced copy for the detectors, full resolution on first use
+"""
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# scales opencv can decode directly at reduced size (jpeg decodes at that size, other formats are resized)
+REDUCED_FLAGS = {
+    0.5: cv2.IMREAD_REDUCED_COLOR_2,
+    0.25: cv2.IMREAD_REDUCED_COLOR_4,
+    0.125: cv2.IMREAD_REDUCED_COLOR_8,
+}
+JPEG_EXTS = ('.jpg', '.jpeg', '.jpe')
+
+def count_pages(path):
+    '''
+    number of pages of a (multi-page) tiff, 1 for other images; only the file headers are read
+    '''
+    if os.path.splitext(path)[1].lower() not in ('.tif', '.tiff'):
+        return 1
+    with Image.open(path) as img:
+        return getattr(img, 'n_frames', 1)
+
+def read_page(path, index):
+    '''
+    decode a single page as a BGR array, like cv2.imread for the first page
+    '''
+    if index == 0:
+        return cv2.imread(path)
+    with Image.open(path) as img:
+        img.seek(index)
+        return np.ascontiguousarray(np.asarray(img.convert('RGB'))[:, :, ::-1])
+
+def scale_location(location, fx, fy):
+    return [(int(round(x * fx)), int(round(y * fy))) for (x, y) in location]
+
+def scale_boxes(boxes, fx, fy):
+    '''
+    map detector output computed on the reduced page back to page coordinates
+    '''
+    if fx == 1 and fy == 1:
+        return boxes
+    scaled = []
+    for box in boxes:
+        box = box.copy()
+        box['location'] = scale_location(box['location'], fx, fy)
+        scaled.append(box)
+    return scaled
+
+class Page:
+    def __init__(self, path, index=0, image=None, digest=None):
+        self.path = path
+        self.index = index
+        self.digest = digest # content digest of the document, for checkpoint keys
+        self._full = image
+        self._small = None # (scale, reduced image, (fx, fy))
+
+    @property
+    def full(self):
+        if self._full is None:
+            self._full = read_page(self.path, self.index)
+        return self._full
+
+    def detect_image(self, scale=1.0):
+        '''
+        return the image for the detectors and (fx, fy) mapping its coordinates to the full page
+        the full page is not decoded when the file can be decoded at reduced size directly
+        '''
+        if scale >= 1:
+            return self.full, (1., 1.)
+        if self._small is None or self._small[0] != scale:
+            self._small = (scale,) + self.reduce(scale)
+        return self._small[1], self._small[2]
+
+    def reduce(self, scale):
+        flag = REDUCED_FLAGS.get(scale)
+        if self._full is None and self.index == 0 and flag is not None \
+                and os.path.splitext(self.path)[1].lower() in JPEG_EXTS:
+            return cv2.imread(self.path, flag), (1./scale, 1./scale)
+        full = self.full
+        h, w = full.shape[:2]
+        small = cv2.resize(full, (max(1, int(round(w * scale))), max(1, int(round(h * scale)))), interpolation=cv2.INTER_AREA)
+        return small, (w / float(small.shape[1]), h / float(small.shape[0]))
+
+def page_name(path, index):
+    name = os.path.basename(os.path.splitext(path)[0])
+    if index > 0: # the first page keeps the document name
+        name += '_page' + str(index + 1)
+    return name
@@ -0,0 +1,107 @@
+"""
+pipelined execution of Converter stages over pages: decode -> detect -> OCR -> write
+each stage runs in its own thread, stages are connected by bounded queues
+"""
+import queue
+import threading
+import time
+import traceback
+
+_DONE = object() # end of stream marker
+
+def decode_stage(converter, job):
+    converter.tracer.count('pages')
+    job['name'], job['image'] = converter.decode(job['path'], job['page'], job['digest'])
+
+def detect_stage(converter, job):
+    job['extraction'] = converter.extract_coordinate(job['image'])
+
+def ocr_stage(converter, job):
+    job['recognized'] = converter.recognize(job['extraction'])
+
+def write_stage(converter, job):
+    converter.write(job['extraction'], job['image'], job['name'], job['recognized'])
+
+STAGES = [decode_stage, detect_stage, ocr_stage, write_stage]
+
+def stage_worker(converter, stage, inbox, outbox):
+    while True:
+        job = inbox.get()
+        if job is _DONE:
+            outbox.put(_DONE)
+            return
+        if job['status'] == 'ok': # a failed job is passed along untouched
+            converter.tracer.bind(job['trace'])
+            try:
+                stage(converter, job)
+            except Exception as e:
+                job['status'] = 'failed'
+                job['stage'] = stage.__name__
+                job['error'] = repr(e)
+                job['traceback'] = traceback.format_exc()
+        outbox.put(job)
+
+def feed(converter, paths, outbox):
+    '''
+    one job per page, the pages of a path share its start time and trace
+    '''
+    for path in paths:
+        start = time.time()
+        digest = None
+        try:
+            digest = converter.document_digest(path) # hashed once, the stages reuse it
+            if converter.up_to_date(path, digest): # passed along untouched like a failed job
+                outbox.put({'path': path, 'page': 0, 'status': 'skipped', 'start': start, 'trace': None,
+                            'first': True, 'last': True})
+                continue
+        except Exception:
+            pass # an unreadable file fails in decode_stage
+        trace = converter.tracer.begin(path)
+        try:
+            pages = converter.page_indices(path)
+        except Exception:
+            pages = [0]
+        for idx, page in enumerate(pages):
+            outbox.put({
+                'path': path, 'page': page, 'digest': digest, 'status': 'ok', 'start': start, 'trace': trace,
+                'first': idx == 0, 'last': idx == len(pages) - 1
+            })
+    outbox.put(_DONE)
+
+def finish(job, res=None):
+    '''
+    merge the outcome of a page job into the result of its path, the first failure is kept
+    '''
+    if res is None or (res['status'] == 'ok' and job['status'] != 'ok'):
+        res = {key: job[key] for key in ('path', 'status', 'stage', 'error', 'traceback') if key in job}
+    res['elapsed'] = time.time() - job['start']
+    return res
+
+def run_pipelined(converter, paths, queue_depth=2):
+    '''
+    queue_depth bounds the number of pages waiting between two stages,
+    so at most about (queue_depth + 1) * len(STAGES) pages are held in memory
+    yield one result dict per path, in input order
+    '''
+    queue_depth = max(1, queue_depth)
+    queues = [queue.Queue(maxsize=queue_depth) for _ in range(len(STAGES) + 1)]
+    threads = [threading.Thread(target=feed, args=(converter, paths, queues[0]), daemon=True)]
+    for idx, stage in enumerate(STAGES):
+        threads.append(threading.Thread(
+            target=stage_worker, args=(converter, stage, queues[idx], queues[idx+1]), daemon=True
+        ))
+    for t in threads:
+        t.start()
+    res = None
+    while True:
+        job = queues[-1].get()
+        if job is _DONE:
+            break
+        if job['status'] == 'failed':
+            converter.visualize_failure(job.get('extraction'), job.get('image'), job.get('name'))
+        res = finish(job, None if job['first'] else res)
+        if job['last']:
+            converter.tracer.end(job['trace'], res['status'])
+            yield res
+    for t in threads:
+        t.join()
@@ -0,0 +1,63 @@
+"""
+uniform grid spatial index over axis-aligned boxes
+"""
+from math import floor
+
+def corners2bbox(location):
+    '''
+    location: 4-corner coordinates, top-left first and bottom-right third
+    '''
+    (x0, y0), _, (x1, y1), _ = location
+    return [x0, y0, x1, y1]
+
+class SpatialIndex:
+    def __init__(self, boxes, cell_size=None):
+        '''
+        boxes: list of [x0, y0, x1, y1], queries return indices into this list
+        cell_size: side of a grid cell, defaults to the mean box side
+        '''
+        self.boxes = boxes
+        if cell_size is None:
+            sides = [max(x1 - x0, y1 - y0) for x0, y0, x1, y1 in boxes if x1 > x0 and y1 > y0]
+            cell_size = sum(sides)/float(len(sides)) if sides else 1
+        self.cell_size = max(float(cell_size), 1.)
+        self.grid = dict()
+        for idx, box in enumerate(boxes):
+            for key in self.cells_of(box):
+                self.grid.setdefault(key, []).append(idx)
+
+    def cells_of(self, box):
+        x0, y0, x1, y1 = box
+        if x1 <= x0 or y1 <= y0:
+            return
+        cs = self.cell_size
+        for gx in range(floor(x0/cs), floor(x1/cs) + 1):
+            for gy in range(floor(y0/cs), floor(y1/cs) + 1):
+                yield gx, gy
+
+    def query(self, box):
+        '''
+        indices (ascending) of the indexed boxes sharing a positive area with box
+        '''
+        x0, y0, x1, y1 = box
+        if x1 <= x0 or y1 <= y0:
+            return []
+        cs = self.cell_size
+        n_cells = (floor(x1/cs) - floor(x0/cs) + 1) * (floor(y1/cs) - floor(y0/cs) + 1)
+        if n_cells > len(self.grid): # large query box, cheaper to walk the occupied cells
+            buckets = (self.grid[key] for key in self.grid
+                       if floor(x0/cs) <= key[0] <= floor(x1/cs) and floor(y0/cs) <= key[1] <= floor(y1/cs))
+        else:
+            buckets = (self.grid.get(key, ()) for key in self.cells_of(box))
+        seen = set()
+        found = []
+        for bucket in buckets:
+            for idx in bucket:
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                a0, b0, a1, b1 = self.boxes[idx]
+                if min(x1, a1) > max(x0, a0) and min(y1, b1) > max(y0, b0):
+                    found.append(idx)
+        found.sort()
+        return found
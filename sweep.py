@@ -0,0 +1,195 @@
+"""
+speed / accuracy sweep of Converter settings, every configuration is scored with metrics.compare
+run: python sweep.py -c config.json --gt_dir <gt xlsx dir> --output_dir sweep [--sample 50] [--warmup 1]
+                     [--grid detect_scale=1.0,0.5 ocr_batch_size=8,32 merge_gap_threshold=0.1,0.2,0.3]
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import shutil
+import time
+from collections import OrderedDict
+
+from instrument import summarize_trace
+import metrics
+
+# 12 configurations, merge_gap_threshold and header_col_threshold are swept with --grid
+DEFAULT_GRID = OrderedDict([
+    ("detect_scale", [1.0, 0.5]),
+    ("ocr_batch_size", [8, 32]),
+    ("in_cell_threshold", [0.4, 0.5, 0.6]),
+])
+
+# caches and checkpoints would make later configurations look faster, visualizations are not scored
+SWEEP_OVERRIDES = {
+    "ocr_cache_dir": None,
+    "checkpoint_dir": None,
+    "visualize": "off",
+    "pipeline_depth": 0,
+}
+
+def parse_grid(items):
+    '''
+    ["key=v1,v2", ...] -> OrderedDict key -> list of json values
+    '''
+    grid = OrderedDict()
+    for item in items:
+        key, values = item.split('=', 1)
+        grid[key] = [json.loads(value) for value in values.split(',')]
+    return grid
+
+def expand_grid(grid):
+    keys = list(grid)
+    return [OrderedDict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+def sample_paths(data_dir, n=None, seed=0):
+    paths = [os.path.join(data_dir, t) for t in sorted(os.listdir(data_dir))]
+    if n and n < len(paths):
+        paths = sorted(random.Random(seed).sample(paths, n))
+    return paths
+
+def gt_subset(gt_dir, names, out_dir):
+    '''
+    copy the ground truth of the sampled pages to out_dir, metrics.compare scores every file of its gt dir
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    for name in names:
+        src = os.path.join(gt_dir, name + '.xlsx')
+        if os.path.exists(src):
+            shutil.copyfile(src, os.path.join(out_dir, name + '.xlsx'))
+    return out_dir
+
+def run_config(base_config, settings, paths, gt_dir, out_dir, models=(None, None, None), eval_workers=1, warmup=1):
+    '''
+    convert paths with base_config updated by settings, then score the predictions against gt_dir
+    models: (table, layout, ocr) models to reuse, None entries are loaded from the configured weights
+    warmup: documents converted untimed first, so model and allocator warm-up stay out of the throughput
+    return the record of the configuration and the models used
+    '''
+    from convert import Converter # needs the model packages
+    from pages import page_name
+    config = dict(base_config)
+    config.update(SWEEP_OVERRIDES)
+    config.update(settings)
+    config["output_dir"] = out_dir
+    config["trace_path"] = os.path.join(out_dir, "trace.jsonl")
+    # predictions, gt copies and reports of an earlier sweep must not be scored with this configuration
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+
+    converter = Converter(config, *models)
+    models = (converter.table_model, converter.layout_model, converter.ocr_model)
+    for path in paths[:warmup]: # outputs are written again by the timed pass
+        try:
+            converter.run(path)
+        except Exception:
+            pass
+    open(config["trace_path"], 'w').close() # the trace starts with the timed pass
+    failed = 0
+    start = time.perf_counter()
+    for path in paths:
+        try:
+            converter.run(path)
+        except Exception:
+            failed += 1
+    converter.close()
+    elapsed = time.perf_counter() - start
+
+    trace = summarize_trace(config["trace_path"])
+    pages = trace['counts'].get('pages', 0)
+    record = OrderedDict([
+        ('config', os.path.basename(out_dir)),
+        ('settings', settings),
+        ('documents', len(paths)),
+        ('pages', pages),
+        ('failed', failed),
+        ('elapsed', elapsed),
+        ('pages_per_sec', pages/elapsed if elapsed > 0 else 0.),
+        ('stages', {name: {key: stat[key] for key in ('mean', 'p50', 'p90')} for name, stat in trace['stages'].items()}),
+        ('teds_mean', None),
+        ('teds_min', None),
+        ('teds_max', None),
+    ])
+    names = [page_name(path, index) for path in paths for index in converter.page_indices(path)]
+    try:
+        scores = metrics.compare(
+            gt_subset(gt_dir, names, os.path.join(out_dir, "gt")), os.path.join(out_dir, "prediction"),
+            os.path.join(out_dir, "eval"),
+            extension='xlsx', workers=eval_workers
+        )
+        record['teds_max'], record['teds_min'], record['teds_mean'] = scores[1], scores[2], scores[4]
+    except Exception as e: # e.g. no prediction at all, the configuration stays out of the pareto front
+        record['error'] = repr(e)
+    return record, models
+
+def pareto_front(records):
+    '''
+    mark the records not dominated in (pages_per_sec, teds_mean)
+    '''
+    scored = [r for r in records if r['teds_mean'] is not None]
+    for r in records:
+        r['pareto'] = r['teds_mean'] is not None and not any(
+            o['pages_per_sec'] >= r['pages_per_sec'] and o['teds_mean'] >= r['teds_mean']
+            and (o['pages_per_sec'] > r['pages_per_sec'] or o['teds_mean'] > r['teds_mean'])
+            for o in scored
+        )
+    return [r for r in records if r['pareto']]
+
+def write_report(records, grid, output_dir):
+    '''
+    sweep.json: every record, pareto.csv: one row per configuration sorted by throughput
+    '''
+    with open(os.path.join(output_dir, 'sweep.json'), 'w') as f:
+        json.dump(records, f, indent=4)
+    stages = sorted(set(name for r in records for name in r['stages']))
+    header = ['config'] + list(grid) + ['pages_per_sec', 'teds_mean', 'teds_min', 'pareto', 'failed'] \
+        + ['%s_mean' % name for name in stages]
+    rows = sorted(records, key=lambda r: -r['pages_per_sec'])
+    with open(os.path.join(output_dir, 'pareto.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for r in rows:
+            writer.writerow(
+                [r['config']] + [r['settings'].get(key) for key in grid]
+                + [round(r['pages_per_sec'], 4), r['teds_mean'], r['teds_min'], int(r['pareto']), r['failed']]
+                + [round(r['stages'][name]['mean'], 4) if name in r['stages'] else '' for name in stages]
+            )
+    print('\n%-12s %10s %10s  %s' % ('config', 'pages/s', 'teds', 'settings'))
+    for r in rows:
+        if r['pareto']:
+            settings = ' '.join('%s=%s' % item for item in r['settings'].items())
+            print('%-12s %10.3f %10s  %s' % (r['config'], r['pages_per_sec'], r['teds_mean'], settings))
+
+def sweep(base_config, grid, paths, gt_dir, output_dir, eval_workers=1, warmup=1):
+    os.makedirs(output_dir, exist_ok=True)
+    records = []
+    models = (None, None, None) # loaded once, reused by every configuration
+    for idx, settings in enumerate(expand_grid(grid)):
+        out_dir = os.path.join(output_dir, 'config_%03d' % idx)
+        record, models = run_config(base_config, settings, paths, gt_dir, out_dir, models, eval_workers, warmup)
+        records.append(record)
+        print('%s %s: %.3f pages/s, mean TEDS %s' % (record['config'], dict(settings), record['pages_per_sec'], record['teds_mean']))
+    pareto_front(records)
+    write_report(records, grid, output_dir)
+    return records
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config_path', default='config.json', help='path to config')
+    parser.add_argument('--data_dir', default=None, help='images to convert, defaults to config data_dir')
+    parser.add_argument('--gt_dir', required=True, help='ground truth xlsx files, named like the predictions')
+    parser.add_argument('--output_dir', default='sweep', help='one sub directory per configuration')
+    parser.add_argument('--sample', type=int, default=None, help='number of images sampled from data_dir')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--grid', nargs='*', default=None, help='key=v1,v2 ... (json values), replaces the default grid')
+    parser.add_argument('--eval_workers', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=1, help='documents converted untimed before each configuration')
+    args = parser.parse_args()
+    config = json.load(open(args.config_path))
+
+    grid = parse_grid(args.grid) if args.grid else DEFAULT_GRID
+    paths = sample_paths(args.data_dir or config["data_dir"], args.sample, args.seed)
+    sweep(config, grid, paths, args.gt_dir, args.output_dir, args.eval_workers, args.warmup)
@@ -0,0 +1,128 @@
+"""
+compact root -> rows -> cells table tree backed by parallel arrays
+"""
+import numpy as np
+
+from label_distance import LABEL_DISTANCE
+
+class LabelTable:
+    '''
+    append-only table interning node labels into integer ids, scoped to the trees of one comparison,
+    label distances between ids are cached with it
+    '''
+    __slots__ = ('ids', 'values', 'distances')
+
+    def __init__(self):
+        self.ids = dict()
+        self.values = []
+        self.distances = dict()
+
+    def intern(self, label):
+        key = (label.__class__, label) # 1, 1.0 and True are different labels
+        idx = self.ids.get(key, None)
+        if idx is None:
+            idx = len(self.values)
+            self.ids[key] = idx
+            self.values.append(label)
+        return idx
+
+    def __getitem__(self, idx):
+        return self.values[idx]
+
+    def distance(self, a, b):
+        '''
+        label distance of ids a and b (levenshtein is symmetric)
+        '''
+        key = (a, b) if a <= b else (b, a)
+        dist = self.distances.get(key, None)
+        if dist is None:
+            dist = LABEL_DISTANCE.compute(self.values[a], self.values[b])
+            self.distances[key] = dist
+        return dist
+
+class TableTree:
+    '''
+    title: label id of the root
+    row_labels: label id of every row
+    row_offsets: cells of row r are cells[row_offsets[r]:row_offsets[r+1]]
+    labels, rowspans, colspans: label id and spans of every cell in row-major order
+    label_table: LabelTable of the ids, shared by the trees compared together (a new one by default)
+    built with add_row/add_cell, then freeze() turns the lists into arrays
+    '''
+    __slots__ = ('title', 'row_labels', 'row_offsets', 'labels', 'rowspans', 'colspans', 'label_table')
+
+    def __init__(self, title, label_table=None):
+        self.label_table = label_table if label_table is not None else LabelTable()
+        self.title = self.label_table.intern(title)
+        self.row_labels = []
+        self.row_offsets = [0]
+        self.labels = []
+        self.rowspans = []
+        self.colspans = []
+
+    def add_row(self, label):
+        self.row_labels.append(self.label_table.intern(label))
+        self.row_offsets.append(self.row_offsets[-1])
+
+    def add_cell(self, label, rowspan, colspan):
+        self.labels.append(self.label_table.intern(label))
+        self.rowspans.append(rowspan)
+        self.colspans.append(colspan)
+        self.row_offsets[-1] += 1
+
+    def freeze(self):
+        self.row_labels = np.asarray(self.row_labels, dtype=np.int64)
+        self.row_offsets = np.asarray(self.row_offsets, dtype=np.int64)
+        self.labels = np.asarray(self.labels, dtype=np.int64)
+        self.rowspans = np.asarray(self.rowspans, dtype=np.int64)
+        self.colspans = np.asarray(self.colspans, dtype=np.int64)
+        return self
+
+    @property
+    def n_rows(self):
+        return len(self.row_labels)
+
+    @property
+    def n_cells(self):
+        return len(self.labels)
+
+    def num_nodes(self):
+        '''
+        number of nodes without the root
+        '''
+        return self.n_rows + self.n_cells
+
+    def leaf_arrays(self):
+        '''
+        label ids, rowspans and colspans of the leaves from left to right, spans are -1 for a leaf that is not a cell:
+        a row without cells is a leaf itself and so is the root of a tree without rows
+        '''
+        if self.n_rows == 0:
+            return np.array([self.title]), np.array([-1]), np.array([-1])
+        empty = np.flatnonzero(self.row_offsets[1:] == self.row_offsets[:-1])
+        if len(empty) == 0:
+            return self.labels, self.rowspans, self.colspans
+        at = self.row_offsets[empty] # the leaf of an empty row comes before the cells of the next rows
+        return np.insert(self.labels, at, self.row_labels[empty]), np.insert(self.rowspans, at, -1), np.insert(self.colspans, at, -1)
+
+    def leaves(self):
+        '''
+        labels and (rowspan, colspan) of the leaves from left to right, (None, None) for a leaf that is not a cell
+        '''
+        ids, rowspans, colspans = self.leaf_arrays()
+        values = self.label_table.values
+        labels = [values[idx] for idx in ids.tolist()]
+        spans = [(None, None) if rowspan < 0 else (rowspan, colspan) for rowspan, colspan in zip(rowspans.tolist(), colspans.tolist())]
+        return labels, spans
+
+    def rows(self):
+        '''
+        iterate (row label, [(cell label, rowspan, colspan)])
+        '''
+        offsets = self.row_offsets
+        for row in range(self.n_rows):
+            cells = [
+                (self.label_table[self.labels[idx]], int(self.rowspans[idx]), int(self.colspans[idx]))
+                for idx in range(offsets[row], offsets[row + 1])
+            ]
+            yield self.label_table[self.row_labels[row]], cells
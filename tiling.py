@@ -0,0 +1,148 @@
+"""
+tiled detection: run the detectors on overlapping tiles of a large page and merge the results
+"""
+from instrument import NullTracer
+from spatial import SpatialIndex, corners2bbox
+from utility import find_root
+
+def tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    step = max(1, tile - overlap)
+    starts = list(range(0, length - tile, step))
+    starts.append(length - tile) # last tile ends at the border
+    return starts
+
+def make_tiles(shape, tile, overlap):
+    '''
+    (x0, y0, x1, y1) of overlapping tiles of at most tile x tile pixels covering an image of shape
+    '''
+    h, w = shape[:2]
+    return [
+        (x0, y0, min(x0 + tile, w), min(y0 + tile, h))
+        for y0 in tile_starts(h, tile, overlap)
+        for x0 in tile_starts(w, tile, overlap)
+    ]
+
+def shift_location(location, dx, dy):
+    return [(x + dx, y + dy) for (x, y) in location]
+
+def cut_by_tile(bbox, tile, shape, margin=2):
+    '''
+    True when bbox touches a tile border that is inside the page, the box may be cut there
+    '''
+    x0, y0, x1, y1 = bbox
+    tx0, ty0, tx1, ty1 = tile
+    h, w = shape[:2]
+    return (tx0 > 0 and x0 <= tx0 + margin) or (ty0 > 0 and y0 <= ty0 + margin) \
+        or (tx1 < w and x1 >= tx1 - margin) or (ty1 < h and y1 >= ty1 - margin)
+
+def area(bbox):
+    x0, y0, x1, y1 = bbox
+    return max(0, x1 - x0) * max(0, y1 - y0)
+
+def suppress(bboxes, cut, threshold=0.5):
+    '''
+    non-maximum suppression of duplicates from overlapping tiles, return the kept indices in input order
+    boxes that are not cut by a tile border win, then larger boxes; a box is dropped when more than
+    `threshold` of the smaller of the two boxes is covered by a kept box (a cut copy lies inside the full one)
+    '''
+    index = SpatialIndex(bboxes)
+    order = sorted(range(len(bboxes)), key=lambda i: (cut[i], -area(bboxes[i]), i))
+    kept = set()
+    for idx in order:
+        x0, y0, x1, y1 = bboxes[idx]
+        duplicate = False
+        for other in index.query(bboxes[idx]):
+            if other not in kept:
+                continue
+            a0, b0, a1, b1 = bboxes[other]
+            inter = (min(x1, a1) - max(x0, a0)) * (min(y1, b1) - max(y0, b0))
+            smaller = min(area(bboxes[idx]), area(bboxes[other]))
+            if smaller > 0 and inter > threshold * smaller:
+                duplicate = True
+                break
+        if not duplicate:
+            kept.add(idx)
+    return sorted(kept)
+
+def detect_tiles(image, table_model, layout_model, tile, overlap=256, tracer=None):
+    '''
+    run both detectors on every tile, locations are moved to page coordinates
+    return tables (tile, table box, its cells), other table model boxes and layouts, each with the tile
+    '''
+    tracer = tracer or NullTracer()
+    tables = []
+    others = []
+    layouts = []
+    for tile_box in make_tiles(image.shape, tile, overlap):
+        x0, y0, x1, y1 = tile_box
+        view = image[y0:y1, x0:x1] # the detectors only ever see tile-sized inputs
+        with tracer.stage('table_model'):
+            boxes = table_model.process(view, resize=True, refine=True)
+        with tracer.stage('layout_model'):
+            lays = layout_model.process(view)
+        for box in boxes:
+            box['location'] = shift_location(box['location'], x0, y0)
+        contained = set()
+        for box in boxes:
+            if box['type'] == 'table':
+                cells = [boxes[idx] for idx in box['contains']]
+                contained.update(box['contains'])
+                tables.append((tile_box, box, cells))
+        others.extend((tile_box, box) for idx, box in enumerate(boxes) if box['type'] != 'table' and idx not in contained)
+        for lay in lays:
+            lay['location'] = shift_location(lay['location'], x0, y0)
+            layouts.append((tile_box, lay))
+    return tables, others, layouts
+
+def dedupe(items, shape, threshold):
+    bboxes = [corners2bbox(box['location']) for _, box in items]
+    cut = [cut_by_tile(bbox, tile_box, shape) for bbox, (tile_box, _) in zip(bboxes, items)]
+    return [items[idx][1] for idx in suppress(bboxes, cut, threshold)]
+
+def merge_tables(tables, shape, threshold):
+    '''
+    union the regions of tables from different tiles that overlap (the same table seen by several tiles),
+    cells of the merged tables are deduplicated like layouts
+    return a list of (table box, cells)
+    '''
+    bboxes = [corners2bbox(box['location']) for _, box, _ in tables]
+    parent = list(range(len(tables)))
+    index = SpatialIndex(bboxes)
+    for idx, bbox in enumerate(bboxes):
+        for other in index.query(bbox):
+            if other < idx and tables[other][0] != tables[idx][0]:
+                parent[find_root(parent, idx)] = find_root(parent, other)
+    groups = dict()
+    for idx in range(len(tables)):
+        groups.setdefault(find_root(parent, idx), []).append(idx)
+
+    merged = []
+    for members in groups.values():
+        x0 = min(bboxes[idx][0] for idx in members)
+        y0 = min(bboxes[idx][1] for idx in members)
+        x1 = max(bboxes[idx][2] for idx in members)
+        y1 = max(bboxes[idx][3] for idx in members)
+        table = tables[members[0]][1].copy()
+        table['location'] = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+        cells = dedupe([(tables[idx][0], cell) for idx in members for cell in tables[idx][2]], shape, threshold)
+        merged.append((table, cells))
+    return merged
+
+def tiled_detection(image, table_model, layout_model, tile, overlap=256, threshold=0.5, tracer=None):
+    '''
+    same output as (table_model.process(image), layout_model.process(image)) computed tile by tile
+    '''
+    tables, others, layouts = detect_tiles(image, table_model, layout_model, tile, overlap, tracer)
+    refined_boxes = []
+    cell_boxes = []
+    merged = merge_tables(tables, image.shape, threshold)
+    offset = len(merged)
+    for table, cells in merged:
+        table['contains'] = list(range(offset + len(cell_boxes), offset + len(cell_boxes) + len(cells)))
+        refined_boxes.append(table)
+        cell_boxes.extend(cells)
+    refined_boxes.extend(cell_boxes)
+    refined_boxes.extend(dedupe(others, image.shape, threshold))
+    return refined_boxes, dedupe(layouts, image.shape, threshold)
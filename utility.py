@@ -1,5 +1,7 @@
 import cv2
+from heapq import heappush, heappop
 from utils import sort_layout_output
+from spatial import SpatialIndex, corners2bbox
 
 def location2bbox(location):
     xmin = min(p[0] for p in location)
@@ -45,12 +47,22 @@ def check_layout_in_cell(lay, ce, threshold=0.5):
     iou = intersection/float(area)
     return (iou > threshold)
 
-def define_containers(layout_output, cells):
+def find_container(lay, containers, index, threshold=0.5):
+    '''
+    index: SpatialIndex built over the containers
+    return the first container holding lay above threshold, None if there is none
+    '''
+    for idx in index.query(corners2bbox(lay['location'])):
+        if check_layout_in_cell(lay, containers[idx], threshold):
+            return idx
+    return None
+
+def define_containers(layout_output, cells, threshold=0.5):
+    index = SpatialIndex([corners2bbox(ce['location']) for ce in cells])
     for lay in layout_output:
-        for idx, ce in enumerate(cells):
-            if check_layout_in_cell(lay, ce):
-                lay['belong'] = idx
-                break
+        idx = find_container(lay, cells, index, threshold)
+        if idx is not None:
+            lay['belong'] = idx
         if lay.get('belong', None) is None:
             lay['belong'] = 0 # None
     return layout_output
@@ -68,12 +80,12 @@ def is_available_merged(lay1, lay2, threshold=0.2):
         return True
     return False
 
-def merge_layouts(layout_output):
+def merge_layouts(layout_output, threshold=0.2):
     res = []
     pivot = 0
     for idx, lay in enumerate(layout_output):
         if idx < len(layout_output) - 1:
-            if not is_available_merged(lay, layout_output[idx+1]):
+            if not is_available_merged(lay, layout_output[idx+1], threshold):
                 x0, y0 = layout_output[pivot]['location'][0]
                 x1, y1 = lay['location'][2]
                 merged_layout = {
@@ -98,46 +110,74 @@ def is_same_col(lay1, lay2, threshold=0.2):
         return True
     return False
 
-def classify_cols(layout_output):
-#     idxt = 0
+def find_root(parent, idx):
+    while parent[idx] != idx:
+        parent[idx] = parent[parent[idx]]
+        idx = parent[idx]
+    return idx
+
+def cluster_cols(layout_output):
+    '''
+    cluster the non-header layouts into columns: 2 layouts share a column when they are connected
+    by a chain of is_same_col pairs. Layouts are swept by left edge and merged with union-find;
+    every active column keeps the 2 members that can still match a new layout: the one reaching
+    furthest right and the one maximizing 0.8*x1 + 0.2*x0 (overlap above 0.2 of its own width)
+    set 'col_lead' (smallest index of the column) and return the leaders
+    '''
+    if len(layout_output) == 0:
+        return []
     for idxt, lay in enumerate(layout_output):
         if lay['line'] != 0:
             break
-    if len(layout_output) == 0:
-        return []
-    layout_output[idxt]['col_lead'] = idxt
-    leaders = [] # leader of colums
-    leaders.append(idxt)   
-    for idx, lay in enumerate(layout_output[idxt+1:]):
-        for i in range(idxt, idxt + idx + 1):
-            if is_same_col(lay, layout_output[i]):
-                lay['col_lead'] = layout_output[i]['col_lead']
-                break
-        if lay.get('col_lead', None) is None:
-            lay['col_lead'] = idx + idxt + 1
-            leaders.append(idx + idxt + 1)
-    return leaders
+    indices = list(range(idxt, len(layout_output)))
+    parent = {idx: idx for idx in indices}
+    best = dict() # root -> [member with max x1, member with max 0.8*x1 + 0.2*x0]
+    heap = [] # (x1 reach, root) of active columns, stale entries are skipped
+    active = set()
 
-def combine_cols(layout_output, leaders):
-    idxt = leaders[0]
-    for lay1 in layout_output[idxt:]:
-        for lay2 in layout_output[idxt:]:
-            if lay1['col_lead'] != lay2['col_lead']:
-                if is_same_col(lay1, lay2):
-                    true_leader = min(lay1['col_lead'], lay2['col_lead'])
-                    fake_leader = max(lay1['col_lead'], lay2['col_lead'])
-                    lay1['col_lead'] = true_leader
-                    lay1['col_lead'] = true_leader
-                    if fake_leader in leaders:
-                        leaders.remove(fake_leader)
+    def reach(idx):
+        return layout_output[idx]['bbox'][2]
+
+    def lean(idx):
+        x0, _, x1, _ = layout_output[idx]['bbox']
+        return 0.8 * x1 + 0.2 * x0
+
+    for idx in sorted(indices, key=lambda i: (layout_output[i]['bbox'][0], i)):
+        lay = layout_output[idx]
+        x0 = lay['bbox'][0]
+        while heap and heap[0][0] <= x0: # columns ending before this layout can't match it any more
+            _, root = heappop(heap)
+            if root in active and reach(best[root][0]) <= x0:
+                active.discard(root)
+        matched = [root for root in active if any(is_same_col(lay, layout_output[m]) for m in best[root])]
+        root = idx
+        best[root] = [idx, idx]
+        for other in matched:
+            active.discard(other)
+            a, b = best.pop(other)
+            r_a, r_b = best.pop(root)
+            parent[max(root, other)] = min(root, other)
+            root = min(root, other)
+            best[root] = [max((a, r_a), key=reach), max((b, r_b), key=lean)]
+        active.add(root)
+        heappush(heap, (reach(best[root][0]), root))
+
+    leaders = []
+    for idx in indices:
+        root = find_root(parent, idx)
+        layout_output[idx]['col_lead'] = root
+        if root == idx:
+            leaders.append(idx)
+    return leaders
 
 def define_col_cluster(leaders, layout_output):
     idxt = leaders[0]
     def criteria(idx):
         return layout_output[idx]['bbox'][0]
     leaders.sort(key=criteria)
+    rank = {lead: col for col, lead in enumerate(leaders)}
     for i, lay in enumerate(layout_output[idxt:]):
-        lay['col'] = leaders.index(lay['col_lead'])
+        lay['col'] = rank[lay['col_lead']]
 
 def cells_same_col(c1, c2, threshold=0.8):
     location1 = c1['location']
@@ -153,7 +193,7 @@ def cells_same_col(c1, c2, threshold=0.8):
         return False
     return True
 
-def define_headers(layout_output, leaders, cells):
+def define_headers(layout_output, leaders, cells, threshold=0.8):
     headers = []
     leaders_clone = leaders.copy()
     for idx, h in enumerate(layout_output):
@@ -162,7 +202,7 @@ def define_headers(layout_output, leaders, cells):
             head = [] # set of cols belonging to this header
             for l in leaders:
                 c2 = cells[layout_output[l]['belong']]
-                if cells_same_col(c1, c2) and l in leaders_clone:
+                if cells_same_col(c1, c2, threshold) and l in leaders_clone:
                     head.append(l)
                     leaders_clone.remove(l)
             headers.append(head)
@@ -183,12 +223,15 @@ def define_headers(layout_output, leaders, cells):
         if lay['line'] != 0:
             lay['col'] = layout_output[lay['col_lead']]['col']
 
-def locate_layouts(cells, layouts):
+def locate_layouts(cells, layouts, in_cell=0.5, merge_gap=0.2, header_col=0.8):
+    '''
+    in_cell: check_layout_in_cell threshold, merge_gap: is_available_merged threshold,
+    header_col: cells_same_col threshold
+    '''
     layout_output = sort_layout_output(layouts) # sorted layout from left to right, top to down and define lines of layout
-    layout_output = define_containers(layout_output, cells) # define which cell contains layout
-    layout_output = merge_layouts(layout_output) # merge layouts besides each other
-    leaders = classify_cols(layout_output) # classify layout into right columns
-    combine_cols(layout_output, leaders) # combine columns that haven't been right
+    layout_output = define_containers(layout_output, cells, in_cell) # define which cell contains layout
+    layout_output = merge_layouts(layout_output, merge_gap) # merge layouts besides each other
+    leaders = cluster_cols(layout_output) # classify layout into right columns
     define_col_cluster(leaders, layout_output) # define clusters into right colums
-    define_headers(layout_output, leaders, cells) # place columns into right header
+    define_headers(layout_output, leaders, cells, header_col) # place columns into right header
     return layout_output
\ No newline at end of file
@@ -4,7 +4,6 @@ import glob
 import os
 import json
 import tqdm
-from functools import cmp_to_key
 import re
 import copy
 
@@ -13,6 +12,37 @@ def is_title(text):
     if len(re.split(r"(:)", text)) > 1: return True
     return False
 
+def slice_bounds(start, stop, size):
+    """
+    bounds of array[start:stop] on an array of length size (negative values wrap like numpy slicing)
+    """
+    if start < 0:
+        start += size
+    if stop < 0:
+        stop += size
+    start = min(max(start, 0), size)
+    stop = min(max(stop, 0), size)
+    return start, stop
+
+def interval_overlap(a0, a1, b0, b1):
+    """
+    length of the intersection of [a0, a1) and [b0, b1) on integer coordinates,
+    same as masking both intervals on np.zeros(max(a1, b1)) and counting the common ones
+    """
+    size = max(a1, b1, 0)
+    a0, a1 = slice_bounds(a0, a1, size)
+    b0, b1 = slice_bounds(b0, b1, size)
+    return max(0, min(a1, b1) - max(a0, b0))
+
+def overlap_rate(a0, a1, b0, b1):
+    """
+    overlap of 2 intervals divided by the shorter one, None when the shorter one is empty
+    """
+    length = min(a1 - a0, b1 - b0)
+    if length == 0:
+        return None
+    return interval_overlap(a0, a1, b0, b1) / float(length)
+
 def is_horizontal_overlap(
     key_loc, field_loc, val_max=10000000, offset=None, right_side=True, thres=0.0
 ):
@@ -43,24 +73,13 @@ def is_horizontal_overlap(
     x, y = int(x), int(y)
     x_, y_ = int(x_), int(y_)
 
-    # get y max
-    y_max = int(max(y_, y1))
-    Y = np.zeros((y_max, 2))
-    Y[y0:y1, 0] = 1
-    Y[y:y_, 1] = 1
-    Y = Y.prod(axis=-1)
-
     # is horizontal
     isHorizontal = False
-    if right_side:
-        if (x > x0) and (x < val_max):  # field is on the right side of considered key
-            isHorizontal = (
-                Y.sum() / min(y1 - y0, y_ - y) > thres
-            )  # max(y1-y0, y_-y)>thres
-
-    else:
-        isHorizontal = Y.sum() / min(y1 - y0, y_ - y) > thres  # max(y1-y0, y_-y) >thres
-
+    if right_side and not ((x > x0) and (x < val_max)):  # field is not on the right side of considered key
+        return isHorizontal
+    rate = overlap_rate(y0, y1, y, y_)
+    if rate is not None:
+        isHorizontal = rate > thres  # max(y1-y0, y_-y)>thres
     return isHorizontal
 
 def is_vertical_overlap(
@@ -93,25 +112,58 @@ def is_vertical_overlap(
     x, y = int(x), int(y)
     x_, y_ = int(x_), int(y_)
 
-    # get x max
-    x_max = int(max(x_, x1))
-    X = np.zeros((x_max, 2))
-    X[x0:x1, 0] = 1
-    X[x:x_, 1] = 1
-    X = X.prod(axis=-1)
-
-    # is horizontal
+    # is vertical
     isVertical = False
-    if down_side:
-        if (y > y0) and (y < val_max):  # field is on the right side of considered key
-            isVertical = (
-                X.sum() / min(x1 - x0, x_ - x) > thres
-            )  # max(y1-y0, y_-y)>thres
+    if down_side and not ((y > y0) and (y < val_max)):  # field is not under the considered key
+        return isVertical
+    rate = overlap_rate(x0, x1, x, x_)
+    if rate is not None:
+        isVertical = rate > thres  # max(x1-x0, x_-x)>thres
+    return isVertical
 
-    else:
-        isVertical = X.sum() / min(x1 - x0, x_ - x) > thres  # max(y1-y0, y_-y) >thres
+def overlap_rate_matrix(locations, axis=1):
+    """
+    Description: pairwise overlap rates of N locations in one vectorized call
+    - Input:
+        + locations: list of 4-corner coordinates
+        + axis: 1 compares y intervals (horizontal overlap), 0 compares x intervals (vertical overlap)
+    - Output: NxN float matrix, entry (i, j) is the overlap divided by the shorter interval,
+      nan when the shorter interval is empty
+    """
+    n = len(locations)
+    if n == 0:
+        return np.zeros((0, 0))
+    coords = np.array([[loc[0][axis], loc[2][axis]] for loc in locations], dtype=float).astype(np.int64)
+    start, stop = coords[:, 0], coords[:, 1]
+    size = np.maximum(np.maximum(stop[:, None], stop[None, :]), 0)
+
+    def bounds(a, b):
+        a = np.clip(np.where(a < 0, a + size, a), 0, size)
+        b = np.clip(np.where(b < 0, b + size, b), 0, size)
+        return a, b
+
+    a0, a1 = bounds(np.broadcast_to(start[:, None], size.shape), np.broadcast_to(stop[:, None], size.shape))
+    b0, b1 = bounds(np.broadcast_to(start[None, :], size.shape), np.broadcast_to(stop[None, :], size.shape))
+    overlap = np.maximum(np.minimum(a1, b1) - np.maximum(a0, b0), 0)
+    lengths = stop - start
+    length = np.minimum(lengths[:, None], lengths[None, :])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = np.where(length != 0, overlap / np.where(length != 0, length, 1).astype(float), np.nan)
+    return rate
+
+def horizontal_overlap_matrix(locations, thres=0.0):
+    """
+    batched is_horizontal_overlap(loc_i, loc_j, right_side=False, thres=thres) for every pair
+    """
+    with np.errstate(invalid='ignore'):
+        return overlap_rate_matrix(locations, axis=1) > thres
 
-    return isVertical
+def vertical_overlap_matrix(locations, thres=0.0):
+    """
+    batched is_vertical_overlap(loc_i, loc_j, down_side=False, thres=thres) for every pair
+    """
+    with np.errstate(invalid='ignore'):
+        return overlap_rate_matrix(locations, axis=0) > thres
 
 def compare_location(textline1, textline2):
     (x1, y1), _, _, _ = textline1["location"]
@@ -123,40 +175,62 @@ def compare_location(textline1, textline2):
     else:
         return y1 - y2
 
+def group_lines(text_list, thres=0.4):
+    """
+    Description: cluster textlines into lines with a sweep over their y intervals
+    - Input:
+        + text_list: list of items with 4-corner "location"
+        + thres: minimal vertical overlap (over the shorter interval) to join a line
+    - Output: list of lines from top to bottom, each one a list of items from left to right
+    """
+    def key(idx):
+        (x0, y0), _, (x1, y1), _ = text_list[idx]["location"]
+        return (y0, x0, idx)
+
+    lines = [] # [y0 sum, y1 sum, items] of every line, y0/y1 means are the line band
+    active = [] # lines that can still receive items
+    for idx in sorted(range(len(text_list)), key=key):
+        (x0, y0), _, (x1, y1), _ = text_list[idx]["location"]
+        # items come by increasing top, a line whose band ends above this top is closed for good
+        active = [line for line in active if line[1]/len(line[2]) > y0]
+        best = None
+        best_rate = thres
+        for line in active:
+            n = len(line[2])
+            b0, b1 = line[0]/n, line[1]/n
+            length = min(y1 - y0, b1 - b0)
+            if length <= 0:
+                continue
+            rate = max(0, min(y1, b1) - max(y0, b0)) / float(length)
+            if rate > best_rate:
+                best = line
+                best_rate = rate
+        if best is None:
+            best = [0., 0., []]
+            lines.append(best)
+            active.append(best)
+        best[0] += y0
+        best[1] += y1
+        best[2].append(idx)
+
+    result = []
+    for _, _, members in lines:
+        members.sort(key=lambda idx: (text_list[idx]["location"][0][0], key(idx)))
+        result.append([text_list[idx] for idx in members])
+    return result
+
 def sort_textline(text_list):
-    return sorted(text_list, key=cmp_to_key(compare_location))
+    return [item for line in group_lines(text_list) for item in line]
 
 
 def sort_layout_output(layout_ouput):
-    # sorting textline
-    layout_ouput = sort_textline(layout_ouput)
-    # adding line and cell info
-    idx = 0
-    sub_idx = 0
-    for i, item in enumerate(layout_ouput):
-        if i > 0:
-            if is_horizontal_overlap(
-                item["location"], layout_ouput[i-1]["location"], right_side=False, thres=0.4
-            ):
-                sub_idx += 1
-                item.update({
-                    "line": idx,
-                    "cell": sub_idx,
-                    #"text": f"line {idx}.{sub_idx}: " + item.get('text'),
-                })
-            else:
-                idx +=1
-                sub_idx = 0
-                item.update({
-                    "line": idx,
-                    "cell": sub_idx,
-                    #"text": f"line {idx}.{sub_idx}: " + item.get('text'),
-                })
-        else:
+    # sorting textline and adding line and cell info in the same pass
+    result = []
+    for idx, line in enumerate(group_lines(layout_ouput)):
+        for sub_idx, item in enumerate(line):
             item.update({
                 "line": idx,
                 "cell": sub_idx,
-                #"text": f"line {idx}.{sub_idx}: " + item.get('text'),
             })
-
-    return layout_ouput
\ No newline at end of file
+            result.append(item)
+    return result
@@ -0,0 +1,48 @@
+"""
+background drawing and encoding of Converter visualizations
+"""
+from multiprocessing.util import Finalize
+import queue
+import sys
+import threading
+import traceback
+
+_DONE = object() # end of stream marker
+
+class VisualWriter:
+    '''
+    calls draw(*args) for every put() on a background thread
+    put() blocks once `maxsize` documents are waiting, so at most that many pages are held in memory
+    the queue is drained when the process exits (also in pool workers) or on close()
+    '''
+    def __init__(self, draw, maxsize=4):
+        self.draw = draw
+        self.queue = queue.Queue(maxsize=max(1, maxsize))
+        self.written = 0
+        self.errors = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        Finalize(None, self.close, exitpriority=10)
+
+    def put(self, *args):
+        self.queue.put(args)
+
+    def loop(self):
+        while True:
+            args = self.queue.get()
+            if args is _DONE:
+                return
+            try:
+                self.draw(*args)
+                self.written += 1
+            except Exception:
+                self.errors += 1 # a broken visualization must not stop the conversion
+                sys.stderr.write(traceback.format_exc())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_DONE)
+        self.thread.join()
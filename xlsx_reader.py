@@ -0,0 +1,209 @@
+"""
+lightweight streaming xlsx reader: cell values and merged ranges only
+"""
+import posixpath
+import re
+import zipfile
+from datetime import datetime
+import xml.etree.ElementTree as ET
+
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils.cell import column_index_from_string, range_boundaries
+from openpyxl.utils.datetime import from_excel, CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900
+
+MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PKG_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+COORD_RE = re.compile(r'^\$?([A-Za-z]{1,3})\$?(\d+)$')
+
+def read_xml(archive, name):
+    try:
+        return ET.fromstring(archive.read(name))
+    except KeyError:
+        return None
+
+def text_of(element):
+    '''
+    text of a shared/inline string: plain <t> or rich text runs, phonetic runs are skipped
+    '''
+    t = element.find(MAIN_NS + 't')
+    if t is not None:
+        return t.text or ''
+    return ''.join(r.findtext(MAIN_NS + 't') or '' for r in element.findall(MAIN_NS + 'r'))
+
+def read_shared_strings(archive, path):
+    root = read_xml(archive, path) if path else None
+    if root is None:
+        return []
+    return [text_of(si) for si in root.findall(MAIN_NS + 'si')]
+
+def read_date_styles(archive, path):
+    '''
+    set of cellXfs indices whose number format is a date format
+    '''
+    root = read_xml(archive, path) if path else None
+    if root is None:
+        return set()
+    formats = dict(BUILTIN_FORMATS)
+    numfmts = root.find(MAIN_NS + 'numFmts')
+    if numfmts is not None:
+        for fmt in numfmts.findall(MAIN_NS + 'numFmt'):
+            formats[int(fmt.get('numFmtId'))] = fmt.get('formatCode')
+    dates = set()
+    xfs = root.find(MAIN_NS + 'cellXfs')
+    if xfs is not None:
+        for idx, xf in enumerate(xfs.findall(MAIN_NS + 'xf')):
+            code = formats.get(int(xf.get('numFmtId', 0)))
+            if code and is_date_format(code):
+                dates.add(idx)
+    return dates
+
+def cast_number(value):
+    if '.' in value or 'E' in value or 'e' in value:
+        return float(value)
+    return int(value)
+
+ISO_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d')
+
+def parse_iso(value):
+    '''
+    datetime of an ISO 8601 cell value (t="d"), datetime.fromisoformat needs python 3.7
+    '''
+    value = value.rstrip('Z')
+    for fmt in ISO_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('invalid ISO 8601 date %r' % value)
+
+class Workbook:
+    def __init__(self, path):
+        self.archive = zipfile.ZipFile(path)
+        rels = read_xml(self.archive, 'xl/_rels/workbook.xml.rels')
+        targets = dict()
+        types = dict()
+        for rel in rels.findall(PKG_REL_NS + 'Relationship'):
+            target = rel.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join('xl', target))
+            targets[rel.get('Id')] = target
+            types[rel.get('Type').rsplit('/', 1)[-1]] = target
+        book = read_xml(self.archive, 'xl/workbook.xml')
+        self.sheets = [] # (title, path in the archive)
+        for sheet in book.find(MAIN_NS + 'sheets').findall(MAIN_NS + 'sheet'):
+            self.sheets.append((sheet.get('name'), targets[sheet.get(REL_NS + 'id')]))
+        self.active = 0
+        view = book.find(MAIN_NS + 'bookViews/' + MAIN_NS + 'workbookView')
+        if view is not None:
+            self.active = int(view.get('activeTab', 0))
+        pr = book.find(MAIN_NS + 'workbookPr')
+        self.epoch = CALENDAR_WINDOWS_1900
+        if pr is not None and pr.get('date1904') in ('1', 'true'):
+            self.epoch = CALENDAR_MAC_1904
+        self.shared_strings = read_shared_strings(self.archive, types.get('sharedStrings'))
+        self.date_styles = read_date_styles(self.archive, types.get('styles'))
+
+    @property
+    def sheetnames(self):
+        return [title for title, _ in self.sheets]
+
+    def cell_value(self, c):
+        kind = c.get('t', 'n')
+        f = c.find(MAIN_NS + 'f')
+        if f is not None and f.text: # openpyxl keeps the formula, not the cached result
+            return '=' + f.text
+        if kind == 'inlineStr':
+            inline = c.find(MAIN_NS + 'is')
+            return text_of(inline) if inline is not None else None
+        value = c.findtext(MAIN_NS + 'v')
+        if value is None:
+            return None
+        if kind == 's':
+            return self.shared_strings[int(value)]
+        if kind == 'b':
+            return bool(int(value))
+        if kind in ('str', 'e'):
+            return value
+        if kind == 'd':
+            return parse_iso(value)
+        value = cast_number(value)
+        if int(c.get('s', 0)) in self.date_styles:
+            return from_excel(value, self.epoch)
+        return value
+
+    def read_table(self, idx):
+        '''
+        return {'title', 'values': dense rows of values, 'merged': (min_col, min_row, max_col, max_row) of merged ranges}
+        values cover the same rows and columns as an openpyxl worksheet (max_row x max_column) and
+        the cells covered by a merged range, except the top-left one, are None
+        '''
+        title, path = self.sheets[idx]
+        cells = dict()
+        merged = []
+        row = 0
+        col = 0
+        with self.archive.open(path) as f:
+            for event, element in ET.iterparse(f, events=('start', 'end')):
+                tag = element.tag
+                if event == 'start':
+                    if tag == MAIN_NS + 'row':
+                        row = int(element.get('r', row + 1))
+                        col = 0
+                    continue
+                if tag == MAIN_NS + 'c':
+                    ref = element.get('r')
+                    if ref:
+                        letters, digits = COORD_RE.match(ref).groups()
+                        row = int(digits)
+                        col = column_index_from_string(letters)
+                    else:
+                        col += 1
+                    cells[(row, col)] = self.cell_value(element)
+                    element.clear()
+                elif tag == MAIN_NS + 'row':
+                    element.clear()
+                elif tag == MAIN_NS + 'mergeCell':
+                    merged.append(tuple(range_boundaries(element.get('ref'))))
+
+        max_row = max([r for r, _ in cells] + [b[3] for b in merged] + [1])
+        max_col = max([c for _, c in cells] + [b[2] for b in merged] + [1])
+        values = [[None] * max_col for _ in range(max_row)]
+        for (r, c), value in cells.items():
+            values[r - 1][c - 1] = value
+        for min_col, min_row, mc, mr in merged:
+            for r in range(min_row, mr + 1):
+                for c in range(min_col, mc + 1):
+                    if (r, c) != (min_row, min_col):
+                        values[r - 1][c - 1] = None
+        return {
+            'title': title,
+            'values': values,
+            'merged': merged
+        }
+
+    def tables(self):
+        return [self.read_table(idx) for idx in range(len(self.sheets))]
+
+    def close(self):
+        self.archive.close()
+
+def load_tables(path):
+    '''
+    every sheet of the xlsx file at path as a compact table, in workbook order
+    '''
+    wb = Workbook(path)
+    try:
+        return wb.tables()
+    finally:
+        wb.close()
+
+def load_active_table(path):
+    wb = Workbook(path)
+    try:
+        return wb.read_table(min(wb.active, len(wb.sheets) - 1))
+    finally:
+        wb.close()